@@ -22,6 +22,9 @@ import time
 from threading import Thread
 import importlib.util
 import wpilib
+from processes.VideoStream import VideoStream
+from processes.NTPublisher import NTPublisher
+from processes.LatencyHistogram import Timing
 from networktables import NetworkTables
 from networktables.util import ChooserControl
 
@@ -31,6 +34,9 @@ NetworkTables.initialize(server=serverIP)
 NetworkTables.deleteAllEntries()
 nTable = NetworkTables.getTable('SmartDashboard').getSubTable('pi')
 
+# Per-frame values go through the publisher: cached entries, only changed values, one flush per frame
+ntPublisher = NTPublisher(nTable)
+
 ##TARGET LIST AND METHODS - move methods to separate class???
 personList = [
     #example entry
@@ -69,48 +75,6 @@ def getTargetMode():
 xFov = 60
 yFov = 34
 
-# Define VideoStream class to handle streaming of video from webcam in separate processing thread
-# Source - Adrian Rosebrock, PyImageSearch: https://www.pyimagesearch.com/2015/12/28/increasing-raspberry-pi-fps-with-python-and-opencv/
-class VideoStream:
-    """Camera object that controls video streaming from the Picamera"""
-    def __init__(self,resolution=(640,480),framerate=30):
-        # Initialize the PiCamera and the camera image stream
-        self.stream = cv2.VideoCapture(0)
-        ret = self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
-        ret = self.stream.set(3,resolution[0])
-        ret = self.stream.set(4,resolution[1])
-            
-        # Read first frame from the stream
-        (self.grabbed, self.frame) = self.stream.read()
-
-	# Variable to control when the camera is stopped
-        self.stopped = False
-
-    def start(self):
-	# Start the thread that reads frames from the video stream
-        Thread(target=self.update,args=()).start()
-        return self
-
-    def update(self):
-        # Keep looping indefinitely until the thread is stopped
-        while True:
-            # If the camera is stopped, stop the thread
-            if self.stopped:
-                # Close camera resources
-                self.stream.release()
-                return
-
-            # Otherwise, grab the next frame from the stream
-            (self.grabbed, self.frame) = self.stream.read()
-
-    def read(self):
-	# Return the most recent frame
-        return self.frame
-
-    def stop(self):
-	# Indicate that the camera and thread should be stopped
-        self.stopped = True
-
 # Define and parse input arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('--modeldir', help='Folder the .tflite file is located in',
@@ -202,23 +166,35 @@ input_std = 127.5
 
 # Initialize frame rate calculation
 frame_rate_calc = 1
-freq = cv2.getTickFrequency()
+
+# Latency histograms per step, sent to NT (and printed without a preview) every few seconds
+timing = Timing()
+TIMING_INTERVAL = 5
+nextTimingReport = time.perf_counter() + TIMING_INTERVAL
 
 # Initialize video stream
 videostream = VideoStream(resolution=(imW,imH),framerate=30).start()
 time.sleep(1)
 
+# Sequence number of the last camera frame we ran inference on
+lastSeq = 0
+
 #for frame1 in camera.capture_continuous(rawCapture, format="bgr",use_video_port=True):
 while True:
 
-    # Start timer (for calculating frame rate)
-    t1 = cv2.getTickCount()
+    # Grab the next new frame from video stream, waiting for one if we already handled the latest.
+    # The frame is not copied, it is ours until the next readNew() call
+    t0 = time.perf_counter()
+    newFrame = videostream.readNew(lastSeq, timeout=1.0)
+    if newFrame is None:
+        continue
+    lastSeq, frameTime, frame = newFrame
 
-    # Grab frame from video stream
-    frame1 = videostream.read()
+    # Start timer (for calculating frame rate)
+    t1 = time.perf_counter()
+    timing.record('capture', (t1 - t0) * 1000.0)
 
     # Acquire frame and resize to expected shape [1xHxWx3]
-    frame = frame1.copy()
     frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     frame_resized = cv2.resize(frame_rgb, (width, height))
     input_data = np.expand_dims(frame_resized, axis=0)
@@ -229,7 +205,11 @@ while True:
 
     # Perform the actual detection by running the model with the image as input
     interpreter.set_tensor(input_details[0]['index'],input_data)
+    t2 = time.perf_counter()
+    timing.record('preprocess', (t2 - t1) * 1000.0)
     interpreter.invoke()
+    t3 = time.perf_counter()
+    timing.record('invoke', (t3 - t2) * 1000.0)
 
     # Retrieve detection results
     boxes = interpreter.get_tensor(output_details[0]['index'])[0] # Bounding box coordinates of detected objects
@@ -280,30 +260,42 @@ while True:
                     pN = pN + 1
                 
 
-    for x in 
-
+    # Detection loop, including drawing when the preview is on
+    t4 = time.perf_counter()
+    timing.record('postprocess', (t4 - t3) * 1000.0)
 
     #populate NT with saved target list
     for x in personList:
-        nTable.getSubTable("targets").getSubTable("person").getSubTable(str(getpNum(x))).putNumber("area", int(getpArea(x)/(1000)))
-        nTable.getSubTable("targets").getSubTable("person").getSubTable(str(getpNum(x))).putNumber("conf", int(getpConf(x)))
-        nTable.getSubTable("targets").getSubTable("person").getSubTable(str(getpNum(x))).putNumber("tX", int(gettX(x)))
-        nTable.getSubTable("targets").getSubTable("person").getSubTable(str(getpNum(x))).putNumber("tY", int(gettY(x)))
+        tgtPath = 'targets/person/' + str(getpNum(x)) + '/'
+        ntPublisher.put(tgtPath + 'area', int(getpArea(x)/(1000)))
+        ntPublisher.put(tgtPath + 'conf', int(getpConf(x)))
+        ntPublisher.put(tgtPath + 'tX', int(gettX(x)))
+        ntPublisher.put(tgtPath + 'tY', int(gettY(x)))
     
     if getTargetMode() == 0:
         personList.sort(key=getpArea)
     if len(personList) > 0:
-        nTable.getSubTable("targets").getSubTable("person").putNumber("Main Target", getpNum(personList[0]))
+        ntPublisher.put('targets/person/Main Target', getpNum(personList[0]))
 
-    # Calculate framerate
-    t2 = cv2.getTickCount()
-    time1 = (t2-t1)/freq
-    frame_rate_calc= 1/time1
+    # Calculate framerate from the smoothed time per frame
+    t5 = time.perf_counter()
+    timing.record('frame', (t5 - t1) * 1000.0)
+    frame_rate_calc = 1000.0 / max(timing.histogram('frame').emaMs, 1e-3)
 
     #send framerate to NT
-    if (show_Preview == False):
-        print(frame_rate_calc)
-    nTable.putNumber("FPS", frame_rate_calc)
+    ntPublisher.put('FPS', frame_rate_calc, tolerance=0.05)
+    ntPublisher.flush()
+    timing.record('publish', (time.perf_counter() - t4) * 1000.0)
+
+    # Latency percentiles every few seconds instead of printing every frame
+    if t5 >= nextTimingReport:
+        nextTimingReport = t5 + TIMING_INTERVAL
+        timingStats = timing.publish(ntPublisher, 'status/timing')
+        ntPublisher.flush()
+        if (show_Preview == False):
+            print('FPS %.1f | ' % frame_rate_calc + ' | '.join(
+                '%s p50 %.1f p95 %.1f p99 %.1fms' % (name, values['p50Ms'], values['p95Ms'], values['p99Ms'])
+                for name, values in timingStats.items()))
 
 
     # Press 'q' to quit
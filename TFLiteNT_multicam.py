@@ -0,0 +1,324 @@
+######## Multi-camera Object Detection Using Tensorflow-trained Classifier #########
+#
+# Description:
+# Same detection pipeline as TFLiteNT_webcam_v4.py, for several cameras in one process (e.g.
+# the robot's front and rear cameras) instead of one process per camera fighting over the cores.
+# Every camera has its own capture thread, pipeline, NT subtable (FroggyVision/<name>/targets/...,
+# FroggyVision/<name>/status/...) and MJPG stream on its own port. All cameras share one
+# interpreter pool: a CameraScheduler decides whose frame gets the next free inference slot.
+#
+# Cameras are given as name=source pairs, the source being a device index, a /dev/video path
+# or a stream URL. Streams go on consecutive ports starting at the --stream port:
+#   python TFLiteNT_multicam.py --modeldir=models/SampleModel --cameras=front=0,rear=1 --pool=2
+# puts front on :8080 and rear on :8081.
+#
+# Put the name of the camera facing the direction of travel in FroggyVision/status/direction
+# and it gets --favor times as many inference slots as each other camera. An empty string
+# shares them evenly.
+
+# Import packages
+import os
+import argparse
+import time
+import importlib.util
+from processes.Telemetry import Telemetry
+from processes.ThermalGovernor import ThermalGovernor, SimulatedTelemetry
+from processes.VideoStream import VideoStream
+from processes.MJPGHandler import MJPGHandler
+from processes.Pipeline import Pipeline
+from processes.LatencyHistogram import Timing
+from processes.Profiler import Profiler
+from processes.RoiSelector import RoiSelector
+from processes.TargetTracker import TargetTracker
+from processes.MotionGate import MotionGate
+from processes.CameraScheduler import CameraScheduler
+from processes.InterpreterPool import InterpreterPool
+from processes.Preprocessor import Preprocessor
+from processes.PostProcessor import PostProcessor, X_FOV, Y_FOV
+from processes.DetectionStages import DetectionStages
+from processes.NTPublisher import NTPublisher
+from processes.TargetConfig import TargetConfig
+from networktables import NetworkTables
+
+#Init NT server
+serverIP='192.168.1.232'
+NetworkTables.initialize(server=serverIP)
+NetworkTables.deleteAllEntries()
+nTable = NetworkTables.getTable('FroggyVision')
+statusTable = nTable.getSubTable('status')
+tgtTable = nTable.getSubTable('targets')
+
+# Shared status (temperature, governor, scheduler) goes under FroggyVision/status,
+# every camera's own values under FroggyVision/<camera name>
+ntPublisher = NTPublisher(nTable)
+
+xFov = X_FOV
+yFov = Y_FOV
+
+# Define and parse input arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--modeldir', help='Folder the .tflite file is located in',
+                    required=True)
+parser.add_argument('--graph', help='Name of the .tflite file, if different than detect.tflite',
+                    default='detect.tflite')
+parser.add_argument('--labels', help='Name of the labelmap file, if different than labelmap.txt',
+                    default='labelmap.txt')
+parser.add_argument('--threshold', help='Minimum confidence threshold for displaying detected objects',
+                    default=0.5)
+parser.add_argument('--resolution', help='Desired webcam resolution in WxH, the same for every camera',
+                    default='1280x720')
+parser.add_argument('--cameras', help='Cameras as name=source pairs, source being a device index, a /dev/video path or a stream URL',
+                    default='front=0,rear=1')
+parser.add_argument('--favor', help='Inference slots the camera named in status/direction gets for every one another camera gets',
+                    default=3)
+parser.add_argument('--edgetpu', help='Use Coral Edge TPU Accelerator to speed up detection',
+                    action='store_true')
+parser.add_argument('--pool', help='Number of interpreters shared by all cameras, or "auto" to time the options at startup and pick one',
+                    default='2')
+parser.add_argument('--stream', help='Address the first camera\'s MJPG stream binds to, HOST:PORT. The others use the following ports',
+                    default='0.0.0.0:8080')
+parser.add_argument('--streamfps', help='Maximum frame rate sent to stream viewers, 0 for every processed frame',
+                    default=15)
+parser.add_argument('--streamkbps', help='Target bitrate of each MJPG stream in kbit/s, 0 turns it off',
+                    default=3000)
+parser.add_argument('--asyncstream', help='Serve all stream viewers from one asyncio thread per camera instead of a thread per viewer',
+                    action='store_true')
+parser.add_argument('--simtemp', help='Drive the thermal governor from a simulated temperature profile, "tempC@seconds,..."',
+                    default=None)
+parser.add_argument('--profiledir', help='Folder profiles started from the status/profile NT entry are written to',
+                    default='profiles')
+parser.add_argument('--roi', help='Once a camera has a main target, run the model on a crop around it',
+                    action='store_true')
+parser.add_argument('--track', help='Track targets between inferences and publish the predicted main target for every camera frame',
+                    action='store_true')
+parser.add_argument('--motion', help='Reuse a camera\'s last detections instead of running the model while its scene does not change',
+                    action='store_true')
+parser.add_argument('--threads', help='Number of CPU threads each interpreter uses (default lets TFLite decide)',
+                    default=None)
+
+args = parser.parse_args()
+
+MODEL_NAME = args.modeldir
+GRAPH_NAME = args.graph
+LABELMAP_NAME = args.labels
+min_conf_threshold = float(args.threshold)
+resW, resH = args.resolution.split('x')
+imW, imH = int(resW), int(resH)
+use_TPU = args.edgetpu
+pool_size = args.pool
+num_threads = int(args.threads) if args.threads else None
+streamHost, streamPort = args.stream.rsplit(':', 1)
+stream_fps = float(args.streamfps)
+stream_async = args.asyncstream
+stream_kbps = float(args.streamkbps)
+favor_ratio = float(args.favor)
+sim_temp = args.simtemp
+profile_dir = args.profiledir
+use_roi = args.roi
+use_tracker = args.track
+use_motion = args.motion
+
+# name=source pairs, sources that are numbers are device indexes
+cameraSpecs = []
+for spec in args.cameras.split(','):
+    name, src = spec.split('=', 1)
+    cameraSpecs.append((name.strip(), int(src) if src.strip().isdigit() else src.strip()))
+
+# Import TensorFlow libraries
+# If tflite_runtime is installed, import interpreter from tflite_runtime, else import from regular tensorflow
+# If using Coral Edge TPU, import the load_delegate library
+pkg = importlib.util.find_spec('tflite_runtime')
+if pkg:
+    from tflite_runtime.interpreter import Interpreter
+    if use_TPU:
+        from tflite_runtime.interpreter import load_delegate
+else:
+    from tensorflow.lite.python.interpreter import Interpreter
+    if use_TPU:
+        from tensorflow.lite.python.interpreter import load_delegate
+
+# If using Edge TPU, assign filename for Edge TPU model
+if use_TPU:
+    # If user has specified the name of the .tflite file, use that name, otherwise use default 'edgetpu.tflite'
+    if (GRAPH_NAME == 'detect.tflite'):
+        GRAPH_NAME = 'edgetpu.tflite'
+
+# Get path to current working directory
+CWD_PATH = os.getcwd()
+
+# Path to .tflite file, which contains the model that is used for object detection
+PATH_TO_CKPT = os.path.join(CWD_PATH,MODEL_NAME,GRAPH_NAME)
+
+# Path to label map file
+PATH_TO_LABELS = os.path.join(CWD_PATH,MODEL_NAME,LABELMAP_NAME)
+
+# Load the label map
+with open(PATH_TO_LABELS, 'r') as f:
+    labels = [line.strip() for line in f.readlines()]
+
+# First label of the COCO starter model is '???', which has to be removed
+if labels[0] == '???':
+    del(labels[0])
+
+# Targeting mode and type are the same for every camera
+targetConfig = TargetConfig(tgtTable, statusTable, labels, tgtMode=0, tgtType="robot")
+
+# Setting status/profile to N samples every thread's stack for N seconds
+profiler = Profiler(statusTable, outDir=os.path.join(CWD_PATH, profile_dir))
+
+# Load the Tensorflow Lite model.
+# If using Edge TPU, use special load_delegate argument
+def makeInterpreter(numThreads=None):
+    if use_TPU:
+        return Interpreter(model_path=PATH_TO_CKPT,
+                           experimental_delegates=[load_delegate('libedgetpu.so.1.0')])
+    return Interpreter(model_path=PATH_TO_CKPT, num_threads=numThreads)
+
+# One pool of interpreters for every camera.
+# There is only one Edge TPU, so with it the pool is always a single interpreter
+if use_TPU:
+    interpreterPool = InterpreterPool(makeInterpreter, size=1)
+elif pool_size == 'auto':
+    interpreterPool = InterpreterPool.auto(makeInterpreter)
+else:
+    interpreterPool = InterpreterPool(makeInterpreter, size=int(pool_size), numThreads=num_threads)
+
+input_details = interpreterPool.input_details
+height = input_details[0]['shape'][1]
+width = input_details[0]['shape'][2]
+
+input_mean = 127.5
+input_std = 127.5
+
+# Temperature, CPU frequency / throttling / load and memory, sampled once a second in the background
+telemetry = Telemetry(interval=1.0).start()
+
+# Steps inference rate and interpreter count down as the Pi heats up, before it throttles
+governor = ThermalGovernor(SimulatedTelemetry.parse(sim_temp) if sim_temp else telemetry)
+
+# Which camera's frame goes next when an inference slot comes free
+scheduler = CameraScheduler([name for name, src in cameraSpecs], slots=interpreterPool.size, ratio=favor_ratio)
+
+def directionChanged(source, key, value, isNew):
+    scheduler.favor(value if isinstance(value, str) else '')
+
+# Don't overwrite a direction the driver station already set
+statusTable.setDefaultString('direction', '')
+statusTable.addEntryListener(directionChanged, immediateNotify=True, key='direction', localNotify=True)
+
+TIMING_INTERVAL = 5
+
+def buildCamera(index, name, src):
+    # Everything one camera needs: capture, its own NT subtable, stream, stages and pipeline.
+    # Returns them in a dict for the main loop
+    camPublisher = NTPublisher(nTable.getSubTable(name))
+    timing = Timing()
+
+    # Extra capture buffers so every frame in flight in the pipeline keeps its own buffer
+    videostream = VideoStream(resolution=(imW,imH),framerate=30,buffers=12,src=src).start()
+    mjpgStream = MJPGHandler(address=(streamHost, int(streamPort) + index), maxFps=stream_fps,
+                             useAsyncio=stream_async, targetKbps=stream_kbps).start()
+
+    # tY has always been scaled with the horizontal FOV, keep it that way so the robot code doesn't change
+    postProcessor = PostProcessor(imW, imH, min_conf_threshold, xFov=xFov, yFov=xFov, ringSize=8)
+    roiSelector = RoiSelector(imW, imH, width, height) if use_roi else None
+    motionGate = MotionGate() if use_motion else None
+    tracker = TargetTracker(postProcessor, camPublisher, timing=timing).start(videostream) if use_tracker else None
+    stages = DetectionStages(videostream, interpreterPool, Preprocessor(input_details[0], input_mean, input_std),
+                             postProcessor, targetConfig, camPublisher, labels, telemetry=telemetry,
+                             onData=mjpgStream.writeData if stream_async else None, timing=timing,
+                             roi=roiSelector, tracker=tracker, motionGate=motionGate, mjpgStream=mjpgStream)
+
+    # Sequence number of the last frame sent down the pipeline, earliest time for the next one
+    # while the governor caps the rate (split evenly between the cameras)
+    state = {'lastSeq': 0, 'nextCapture': 0.0}
+
+    def capture():
+        maxFps = governor.maxFps / len(cameraSpecs)
+        if maxFps > 0:
+            wait = state['nextCapture'] - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            state['nextCapture'] = time.monotonic() + 1.0 / maxFps
+        # Wait for a new frame before asking for a slot, so the slot isn't held waiting on the camera
+        if videostream.waitNew(state['lastSeq'], timeout=1.0) is None:
+            return None
+        if not scheduler.acquire(name, timeout=1.0):
+            return None
+        # Newest frame at the moment the slot was granted
+        newFrame = videostream.readNew(state['lastSeq'], timeout=0, hold=True)
+        if newFrame is None:
+            scheduler.release()
+            return None
+        state['lastSeq'], frameTime, frame = newFrame
+        return {'seq': state['lastSeq'], 'time': frameTime, 'frame': frame, 'slot': True}
+
+    def releaseSlot(job):
+        if job.pop('slot', False):
+            scheduler.release()
+
+    def infer(job):
+        # The slot goes back as soon as the interpreter is done with the frame
+        try:
+            return stages.infer(job)
+        finally:
+            releaseSlot(job)
+
+    def releaseJob(job):
+        releaseSlot(job)
+        stages.releaseJob(job)
+
+    pipeline = Pipeline(queueSize=1, onRelease=releaseJob, timing=timing)
+    pipeline.addSource('capture', capture)
+    pipeline.addStage('acquire', stages.acquire)
+    pipeline.addStage('preprocess', stages.preprocess)
+    pipeline.addStage('infer', infer, workers=interpreterPool.size)
+    pipeline.addStage('postprocess', stages.postprocess, ordered=True)
+    pipeline.addStage('publish', stages.publish)
+    pipeline.addStage('stream', stages.stream)
+
+    return {'name': name, 'ntPublisher': camPublisher, 'videostream': videostream,
+            'mjpgStream': mjpgStream, 'stages': stages, 'tracker': tracker, 'pipeline': pipeline}
+
+cameras = [buildCamera(index, name, src) for index, (name, src) in enumerate(cameraSpecs)]
+time.sleep(1)
+for camera in cameras:
+    camera['pipeline'].start()
+
+# Main thread reports every camera's pipeline stats and the shared status once a second,
+# and the latency histograms every TIMING_INTERVAL seconds
+ticks = 0
+try:
+    while True:
+        time.sleep(1)
+        ticks += 1
+        for camera in cameras:
+            camera['stages'].publishStatus(camera['pipeline'].stats(), timing=ticks % TIMING_INTERVAL == 0)
+            camera['ntPublisher'].flush()
+
+        ntPublisher.put('status/CPU Temp', telemetry.tempC, tolerance=0.1)
+        if governor.update():
+            interpreterPool.setLimit(governor.interpreters)
+        # As many slots as interpreters the governor leaves running
+        scheduler.setSlots(interpreterPool.active)
+        for key, value in governor.state().items():
+            ntPublisher.put('status/governor/' + key, value)
+        for key, value in telemetry.snapshot().items():
+            ntPublisher.put('status/telemetry/' + key, value, tolerance=0.01)
+        schedulerStats = scheduler.stats()
+        ntPublisher.put('status/scheduler/slots', schedulerStats['slots'])
+        ntPublisher.put('status/scheduler/favored', schedulerStats['favored'])
+        for name, grants in schedulerStats['grants'].items():
+            ntPublisher.put('status/scheduler/' + name + 'Grants', grants)
+        ntPublisher.flush()
+except KeyboardInterrupt:
+    pass
+
+# Clean up
+for camera in cameras:
+    camera['pipeline'].stop()
+    if camera['tracker'] is not None:
+        camera['tracker'].stop()
+    camera['mjpgStream'].stop()
+    camera['videostream'].stop()
+telemetry.stop()
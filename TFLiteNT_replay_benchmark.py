@@ -0,0 +1,341 @@
+######## Offline replay benchmark for the TFLiteNT detection pipeline #########
+#
+# Description:
+# Replays a recorded video (or a directory of frames) through the same preprocess / infer /
+# postprocess / publish stages (DetectionStages) and Pipeline that TFLiteNT_webcam_v4.py runs
+# live, without a robot or camera, and reports the results as JSON:
+#   per-stage latency percentiles, end-to-end latency, throughput, drops,
+#   allocations per frame and peak RSS.
+# Run the same recording before and after a change to see what it did.
+#
+# Frames run as fast as the pipeline takes them (--fps 0, every frame is processed) or paced
+# like a camera (--fps N, frames the pipeline is too slow for are skipped like they would be live).
+# NT values are written to a local NetworkTables instance, nothing connects to a robot.
+#
+# Example:
+# python TFLiteNT_replay_benchmark.py --modeldir=models/SampleModel --video=match.mp4 --output=before.json
+
+# Import packages
+import os
+import argparse
+import json
+import resource
+import sys
+import time
+import tracemalloc
+import importlib.util
+from threading import Semaphore, Lock
+import cv2
+import numpy as np
+from processes.ReplayStream import ReplayStream
+from processes.Pipeline import Pipeline
+from processes.InterpreterPool import InterpreterPool
+from processes.Preprocessor import Preprocessor
+from processes.PostProcessor import PostProcessor, X_FOV
+from processes.DetectionStages import DetectionStages
+from processes.NTPublisher import NTPublisher
+from processes.TargetConfig import TargetConfig
+from processes.RoiSelector import RoiSelector
+from processes.MotionGate import MotionGate
+from processes.TiledInference import TiledInference
+from networktables import NetworkTables
+
+# Define and parse input arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--modeldir', help='Folder the .tflite file is located in',
+                    required=True)
+parser.add_argument('--graph', help='Name of the .tflite file, if different than detect.tflite',
+                    default='detect.tflite')
+parser.add_argument('--labels', help='Name of the labelmap file, if different than labelmap.txt',
+                    default='labelmap.txt')
+parser.add_argument('--threshold', help='Minimum confidence threshold for displaying detected objects',
+                    default=0.5)
+parser.add_argument('--video', help='Video file, or directory of images, to replay',
+                    required=True)
+parser.add_argument('--fps', help='Replay at this frame rate like a camera would, 0 runs as fast as the pipeline goes',
+                    default=0)
+parser.add_argument('--frames', help='Stop after this many frames, 0 for the whole recording',
+                    default=0)
+parser.add_argument('--preload', help='Decode every frame before starting so decoding is not timed',
+                    action='store_true')
+parser.add_argument('--encode', help='Also draw the results and JPEG encode every frame like the stream does',
+                    action='store_true')
+parser.add_argument('--allocframes', help='Frames run one at a time with tracemalloc before the timed run to measure allocations',
+                    default=20)
+parser.add_argument('--roi', help='Run the model on a crop around the locked target like the live --roi',
+                    action='store_true')
+parser.add_argument('--roifull', help='With --roi, run the full frame again at least every this many frames',
+                    default=10)
+parser.add_argument('--motion', help='Reuse the last detections while the scene does not change like the live --motion',
+                    action='store_true')
+parser.add_argument('--tiles', help='Add tiled passes like the live --tiles',
+                    action='store_true')
+parser.add_argument('--tilescale', help='With --tiles, tile size as a multiple of the model input size',
+                    default=1.0)
+parser.add_argument('--tilebudget', help='With --tiles, average inference time per frame (ms) the tiled passes have to fit in',
+                    default=100)
+parser.add_argument('--edgetpu', help='Use Coral Edge TPU Accelerator to speed up detection',
+                    action='store_true')
+parser.add_argument('--pool', help='Number of interpreters running inference in parallel, or "auto"',
+                    default='1')
+parser.add_argument('--threads', help='Number of CPU threads each interpreter uses (default lets TFLite decide)',
+                    default=None)
+parser.add_argument('--output', help='Write the JSON report to this file instead of stdout',
+                    default=None)
+
+args = parser.parse_args()
+
+MODEL_NAME = args.modeldir
+GRAPH_NAME = args.graph
+LABELMAP_NAME = args.labels
+min_conf_threshold = float(args.threshold)
+VIDEO_PATH = args.video
+replay_fps = float(args.fps)
+max_frames = int(args.frames)
+alloc_frames = int(args.allocframes)
+use_TPU = args.edgetpu
+pool_size = args.pool
+num_threads = int(args.threads) if args.threads else None
+
+# Import TensorFlow libraries
+# If tflite_runtime is installed, import interpreter from tflite_runtime, else import from regular tensorflow
+# If using Coral Edge TPU, import the load_delegate library
+pkg = importlib.util.find_spec('tflite_runtime')
+if pkg:
+    from tflite_runtime.interpreter import Interpreter
+    if use_TPU:
+        from tflite_runtime.interpreter import load_delegate
+else:
+    from tensorflow.lite.python.interpreter import Interpreter
+    if use_TPU:
+        from tensorflow.lite.python.interpreter import load_delegate
+
+# If using Edge TPU, assign filename for Edge TPU model
+if use_TPU:
+    if (GRAPH_NAME == 'detect.tflite'):
+        GRAPH_NAME = 'edgetpu.tflite'
+
+CWD_PATH = os.getcwd()
+PATH_TO_CKPT = os.path.join(CWD_PATH,MODEL_NAME,GRAPH_NAME)
+PATH_TO_LABELS = os.path.join(CWD_PATH,MODEL_NAME,LABELMAP_NAME)
+
+# Load the label map
+with open(PATH_TO_LABELS, 'r') as f:
+    labels = [line.strip() for line in f.readlines()]
+if labels[0] == '???':
+    del(labels[0])
+
+# Local NT tables only (NetworkTables.initialize() is never called), so the publish stage
+# does all of its usual work without a server to talk to
+nTable = NetworkTables.getTable('FroggyVision')
+ntPublisher = NTPublisher(nTable)
+targetConfig = TargetConfig(nTable.getSubTable('targets'), nTable.getSubTable('status'), labels, tgtMode=0, tgtType="robot")
+
+def makeInterpreter(numThreads=None):
+    if use_TPU:
+        return Interpreter(model_path=PATH_TO_CKPT,
+                           experimental_delegates=[load_delegate('libedgetpu.so.1.0')])
+    return Interpreter(model_path=PATH_TO_CKPT, num_threads=numThreads)
+
+if use_TPU:
+    interpreterPool = InterpreterPool(makeInterpreter, size=1)
+elif pool_size == 'auto':
+    interpreterPool = InterpreterPool.auto(makeInterpreter)
+else:
+    interpreterPool = InterpreterPool(makeInterpreter, size=int(pool_size), numThreads=num_threads)
+
+replay = ReplayStream(VIDEO_PATH, fps=replay_fps, preload=args.preload, maxFrames=max_frames)
+imW, imH = replay.resolution
+
+preprocessor = Preprocessor(interpreterPool.input_details[0], 127.5, 127.5)
+# Same FOV as live, where tY is scaled with the horizontal FOV
+postProcessor = PostProcessor(imW, imH, min_conf_threshold, xFov=X_FOV, yFov=X_FOV, ringSize=6)
+inputH, inputW = interpreterPool.input_details[0]['shape'][1:3]
+roiSelector = RoiSelector(imW, imH, inputW, inputH, fullEvery=int(args.roifull)) if args.roi else None
+motionGate = MotionGate() if args.motion else None
+tiler = TiledInference(interpreterPool, imW, imH, tileScale=float(args.tilescale), budgetMs=float(args.tilebudget),
+                       minScore=min_conf_threshold) if args.tiles else None
+stages = DetectionStages(replay, interpreterPool, preprocessor, postProcessor, targetConfig, ntPublisher, labels,
+                         roi=roiSelector, motionGate=motionGate, tiler=tiler)
+
+# Drawing happens on a copy so preloaded frames stay clean when they are replayed
+encodeFrame = np.empty((imH, imW, 3), np.uint8)
+
+def encode(job):
+    # What the stream stage does for a viewer at full scale
+    np.copyto(encodeFrame, job['frame'])
+    stages.annotate(encodeFrame, job)
+    cv2.imencode('.jpg', encodeFrame)
+    return job
+
+# acquire is the wait for a free interpreter, kept apart so preprocess is only the resize work
+stageFns = [('acquire', stages.acquire), ('preprocess', stages.preprocess), ('infer', stages.infer),
+            ('postprocess', stages.postprocess), ('publish', stages.publish)]
+if args.encode:
+    stageFns.append(('encode', encode))
+
+##ALLOCATIONS
+# Run a few frames one at a time through every stage with tracemalloc on. Per frame, report how
+# far traced memory peaked above where it started (temporary arrays) and how many memory blocks
+# were still allocated afterwards (anything kept). This also warms up the interpreters before timing
+def measureAllocations(nFrames):
+    source = ReplayStream(VIDEO_PATH, maxFrames=nFrames)
+    peaks = []
+    kept = []
+    tracemalloc.start()
+    seq = 0
+    while True:
+        newFrame = source.readNew(seq)
+        if newFrame is None:
+            break
+        seq, frameTime, frame = newFrame
+        job = {'seq': seq, 'time': frameTime, 'frame': frame}
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        blocks = sys.getallocatedblocks()
+        for name, fn in stageFns:
+            job = fn(job)
+            if job is None:
+                break
+        peaks.append(tracemalloc.get_traced_memory()[1] - start)
+        kept.append(sys.getallocatedblocks() - blocks)
+        if job is not None:
+            stages.releaseJob(job)
+    tracemalloc.stop()
+    source.stop()
+    # The first frame sets up caches and lazily created buffers, leave it out
+    if len(peaks) > 1:
+        peaks, kept = peaks[1:], kept[1:]
+    return {'frames': len(peaks),
+            'peakBytesPerFrame': float(np.mean(peaks)) if peaks else 0.0,
+            'maxPeakBytes': int(max(peaks)) if peaks else 0,
+            'keptBlocksPerFrame': float(np.mean(kept)) if kept else 0.0}
+
+allocations = measureAllocations(alloc_frames) if alloc_frames > 0 else None
+# The timed run's frames are numbered from 1 again
+stages.restart()
+##END ALLOCATIONS
+
+##TIMED RUN
+# Every stage call is timed, and every frame that makes it through gets its end-to-end latency
+timings = {name: [] for name, fn in [('capture', None)] + stageFns}
+latencies = []
+
+def timed(name, fn):
+    samples = timings[name]
+    def run(*job):
+        t0 = time.perf_counter()
+        result = fn(*job)
+        samples.append((time.perf_counter() - t0) * 1000.0)
+        return result
+    return run
+
+# Free running, only let as many frames into the pipeline as its queues hold so none get dropped
+# and the result shows how fast the stages go, not how the queues behave
+inFlightMax = interpreterPool.size + 2
+inFlight = Semaphore(inFlightMax) if replay_fps == 0 else None
+countLock = Lock()
+counts = {'captured': 0, 'released': 0, 'done': 0}
+finished = False
+lastSeq = 0
+
+# Only the read is timed, not the wait for room in the pipeline
+readFrame = timed('capture', lambda seq: replay.readNew(seq, hold=True))
+
+def capture():
+    global lastSeq, finished
+    if finished:
+        time.sleep(0.01)
+        return None
+    if inFlight is not None:
+        inFlight.acquire()
+    newFrame = readFrame(lastSeq)
+    if newFrame is None:
+        finished = True
+        if inFlight is not None:
+            inFlight.release()
+        return None
+    lastSeq, frameTime, frame = newFrame
+    with countLock:
+        counts['captured'] += 1
+    return {'seq': lastSeq, 'time': frameTime, 'frame': frame}
+
+def done(job):
+    latencies.append((time.monotonic() - job['time']) * 1000.0)
+    with countLock:
+        counts['done'] += 1
+    return job
+
+def releaseJob(job):
+    stages.releaseJob(job)
+    with countLock:
+        counts['released'] += 1
+    if inFlight is not None:
+        inFlight.release()
+
+pipeline = Pipeline(queueSize=inFlightMax if inFlight is not None else 1, onRelease=releaseJob, lateKey='tiled')
+pipeline.addSource('capture', capture)
+for name, fn in stageFns:
+    workers = interpreterPool.size if name == 'infer' else 1
+    pipeline.addStage(name, timed(name, fn), workers=workers, ordered=(name == 'postprocess'))
+pipeline.addStage('done', done)
+
+startTime = time.monotonic()
+pipeline.start()
+while True:
+    time.sleep(0.05)
+    with countLock:
+        if finished and counts['released'] >= counts['captured']:
+            break
+elapsed = time.monotonic() - startTime
+stats = pipeline.stats()
+pipeline.stop()
+replay.stop()
+if tiler is not None:
+    tiler.stop()
+##END TIMED RUN
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    values = np.array(samples)
+    p50, p90, p95, p99 = np.percentile(values, (50, 90, 95, 99))
+    return {'count': len(samples), 'meanMs': float(values.mean()), 'p50Ms': float(p50), 'p90Ms': float(p90),
+            'p95Ms': float(p95), 'p99Ms': float(p99), 'maxMs': float(values.max())}
+
+report = {
+    'model': PATH_TO_CKPT,
+    'video': VIDEO_PATH,
+    'resolution': [imW, imH],
+    'replayFps': replay_fps,
+    'interpreters': interpreterPool.size,
+    'threadsPerInterpreter': interpreterPool.numThreads,
+    'frames': counts['captured'],
+    'completed': counts['done'],
+    # Every frame either completes or is dropped from a queue or by a stage (e.g. the motion gate
+    # while an inference is in flight, or no interpreter in time), goes stale or fails:
+    # frames = completed + dropped + stale + failed
+    'dropped': sum(s['dropped'] + s['rejected'] for s in stats.values()),
+    'stale': sum(s['stale'] for s in stats.values()),
+    # Errors of the capture source aren't frames
+    'failed': sum(s['errors'] for name, s in stats.items() if name != 'capture'),
+    'acquireTimeouts': stages.acquireTimeouts,
+    'skipped': replay.skipped,
+    'seconds': elapsed,
+    'throughputFps': counts['done'] / elapsed if elapsed > 0 else 0.0,
+    'stages': {name: percentiles(samples) for name, samples in timings.items()},
+    'endToEnd': percentiles(latencies),
+    'allocations': allocations,
+    'roi': roiSelector.stats() if roiSelector is not None else None,
+    'motion': motionGate.stats() if motionGate is not None else None,
+    'tiles': tiler.stats() if tiler is not None else None,
+    # ru_maxrss is in kilobytes on Linux
+    'peakRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+}
+
+text = json.dumps(report, indent=2)
+if args.output:
+    with open(args.output, 'w') as f:
+        f.write(text + '\n')
+else:
+    print(text)
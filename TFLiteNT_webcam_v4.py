@@ -16,15 +16,26 @@
 # Import packages
 import os
 import argparse
-import cv2
-import numpy as np
-import sys
 import time
-from threading import Thread
 import importlib.util
-from processes.PITemp import PITemp
+from processes.Telemetry import Telemetry
+from processes.ThermalGovernor import ThermalGovernor, SimulatedTelemetry
 from processes.VideoStream import VideoStream
 from processes.MJPGHandler import MJPGHandler
+from processes.Pipeline import Pipeline
+from processes.LatencyHistogram import Timing
+from processes.Profiler import Profiler
+from processes.MatchRecorder import MatchRecorder
+from processes.RoiSelector import RoiSelector
+from processes.TargetTracker import TargetTracker
+from processes.MotionGate import MotionGate
+from processes.TiledInference import TiledInference
+from processes.InterpreterPool import InterpreterPool
+from processes.Preprocessor import Preprocessor
+from processes.PostProcessor import PostProcessor, X_FOV, Y_FOV
+from processes.DetectionStages import DetectionStages
+from processes.NTPublisher import NTPublisher
+from processes.TargetConfig import TargetConfig
 from networktables import NetworkTables
 from networktables.util import ChooserControl
 
@@ -36,60 +47,11 @@ nTable = NetworkTables.getTable('FroggyVision')
 statusTable = nTable.getSubTable('status')
 tgtTable = nTable.getSubTable('targets')
 
-mainTgt = tgtTable.getSubTable('mainTgt')
-altTgts = tgtTable.getSubTable('altTgts')
+# Per-frame values go through the publisher: cached entries, only changed values, one flush per frame
+ntPublisher = NTPublisher(nTable)
 
-##START TARGETING MODE and type METHODS
-#tgtModes = ["largest", "centermost", "most_confident"]
-# largest = 0 centermost = 1 most_confident = 2
-def getTargetMode():
-    mode = tgtTable.getNumber('tgtMode', 0)
-    return mode
-
-statusTable.putNumber('tgtMode', 0)
-
-def getTargetType():
-    type = statusTable.getString('tgtType', "robot")
-    return type
-
-statusTable.putString('tgtType', "robot")
-
-
-
-##END TARGETING MODE METHODS
-
-##TARGET LIST AND METHODS
-mainTgtList = [
-    #example entry
-    #{'tgtNum': 0,'area': 0, 'conf': 0.0, 'tX': 0.0, 'tY': 0.0}    
-]
-
-maintN = 1
-
-def gettA(target):
-    return target.get('tA')
-
-def gettConf(target):
-    return target.get('tConf')
-
-def getpNum(target):
-    return target.get('tgtNum')
-
-def gettX(target):
-    return target.get('tX')
-
-def gettY(target):
-    return target.get('tY')
-
-def getXCenter(target):
-    return target.get('xCenter')
-
-def getYCenter(target):
-    return target.get('yCenter')
-##END TARGET LIST METHODS
-
-xFov = 60
-yFov = 34
+xFov = X_FOV
+yFov = Y_FOV
 
 # Define and parse input arguments
 parser = argparse.ArgumentParser()
@@ -105,6 +67,40 @@ parser.add_argument('--resolution', help='Desired webcam resolution in WxH. If t
                     default='1280x720')
 parser.add_argument('--edgetpu', help='Use Coral Edge TPU Accelerator to speed up detection',
                     action='store_true')
+parser.add_argument('--pool', help='Number of interpreters running inference in parallel, or "auto" to time the options at startup and pick one',
+                    default='1')
+parser.add_argument('--stream', help='Address the MJPG stream server binds to, HOST:PORT (0.0.0.0 listens on every interface)',
+                    default='0.0.0.0:8080')
+parser.add_argument('--streamfps', help='Max frame rate sent to each stream viewer, 0 for no cap',
+                    default=0)
+parser.add_argument('--streamkbps', help='Target bitrate of the MJPG stream in kbit/s, quality, size and frame rate adapt to stay under it. 0 turns it off',
+                    default=3000)
+parser.add_argument('--asyncstream', help='Serve all stream viewers from one asyncio thread instead of a thread per viewer (adds a /data detection feed)',
+                    action='store_true')
+parser.add_argument('--simtemp', help='Drive the thermal governor from a simulated temperature profile instead of the sensor, "tempC@seconds,..." e.g. "50@0,82@60,55@120"',
+                    default=None)
+parser.add_argument('--profiledir', help='Folder profiles started from the status/profile NT entry are written to',
+                    default='profiles')
+parser.add_argument('--recorddir', help='Folder match recordings (started with the status/record NT entry) are written to',
+                    default='recordings')
+parser.add_argument('--roi', help='Once there is a main target, run the model on a crop around it for more detail on small targets',
+                    action='store_true')
+parser.add_argument('--roifull', help='With --roi, run the full frame again at least every this many frames',
+                    default=10)
+parser.add_argument('--track', help='Track targets between inferences and publish the predicted main target for every camera frame',
+                    action='store_true')
+parser.add_argument('--motion', help='Reuse the last detections instead of running the model while the scene does not change',
+                    action='store_true')
+parser.add_argument('--motionmaxage', help='With --motion, run the model at least this often (seconds)',
+                    default=1.0)
+parser.add_argument('--tiles', help='Now and then run the model on overlapping full resolution tiles too, for small far away targets',
+                    action='store_true')
+parser.add_argument('--tilescale', help='With --tiles, tile size as a multiple of the model input size',
+                    default=1.0)
+parser.add_argument('--tilebudget', help='With --tiles, average inference time per frame (ms) the tiled passes have to fit in',
+                    default=100)
+parser.add_argument('--threads', help='Number of CPU threads each interpreter uses (default lets TFLite decide)',
+                    default=None)
 
 args = parser.parse_args()
 
@@ -115,6 +111,24 @@ min_conf_threshold = float(args.threshold)
 resW, resH = args.resolution.split('x')
 imW, imH = int(resW), int(resH)
 use_TPU = args.edgetpu
+pool_size = args.pool
+num_threads = int(args.threads) if args.threads else None
+streamHost, streamPort = args.stream.rsplit(':', 1)
+stream_address = (streamHost, int(streamPort))
+stream_fps = float(args.streamfps)
+stream_async = args.asyncstream
+stream_kbps = float(args.streamkbps)
+sim_temp = args.simtemp
+profile_dir = args.profiledir
+record_dir = args.recorddir
+use_roi = args.roi
+roi_full_every = int(args.roifull)
+use_tracker = args.track
+use_motion = args.motion
+motion_max_age = float(args.motionmaxage)
+use_tiles = args.tiles
+tile_scale = float(args.tilescale)
+tile_budget = float(args.tilebudget)
 
 # Import TensorFlow libraries
 # If tflite_runtime is installed, import interpreter from tflite_runtime, else import from regular tensorflow
@@ -154,163 +168,186 @@ with open(PATH_TO_LABELS, 'r') as f:
 if labels[0] == '???':
     del(labels[0])
 
+##TARGETING MODE and type
+#tgtModes = ["largest", "centermost", "most_confident"]
+# largest = 0 centermost = 1 most_confident = 2
+# targets/tgtMode and status/tgtType are cached locally and updated by NT listeners,
+# the loop reads targetConfig.tgtMode and targetConfig.tgtClassId (tgtType resolved to a label id)
+targetConfig = TargetConfig(tgtTable, statusTable, labels, tgtMode=0, tgtType="robot")
+##END TARGETING MODE
+
+# Setting status/profile to N samples every thread's stack for N seconds, the pstats file path
+# comes back in status/profilePath. Nothing runs until then
+profiler = Profiler(statusTable, outDir=os.path.join(CWD_PATH, profile_dir))
+
 # Load the Tensorflow Lite model.
 # If using Edge TPU, use special load_delegate argument
+def makeInterpreter(numThreads=None):
+    if use_TPU:
+        return Interpreter(model_path=PATH_TO_CKPT,
+                           experimental_delegates=[load_delegate('libedgetpu.so.1.0')])
+    return Interpreter(model_path=PATH_TO_CKPT, num_threads=numThreads)
+
 if use_TPU:
-    interpreter = Interpreter(model_path=PATH_TO_CKPT,
-                              experimental_delegates=[load_delegate('libedgetpu.so.1.0')])
     print(PATH_TO_CKPT)
-else:
-    interpreter = Interpreter(model_path=PATH_TO_CKPT)
 
-interpreter.allocate_tensors()
+# Pool of interpreters so inference can use several cores at once.
+# There is only one Edge TPU, so with it the pool is always a single interpreter
+if use_TPU:
+    interpreterPool = InterpreterPool(makeInterpreter, size=1)
+elif pool_size == 'auto':
+    interpreterPool = InterpreterPool.auto(makeInterpreter)
+else:
+    interpreterPool = InterpreterPool(makeInterpreter, size=int(pool_size), numThreads=num_threads)
 
 # Get model details
-input_details = interpreter.get_input_details()
-output_details = interpreter.get_output_details()
+input_details = interpreterPool.input_details
+output_details = interpreterPool.output_details
 height = input_details[0]['shape'][1]
 width = input_details[0]['shape'][2]
 
-floating_model = (input_details[0]['dtype'] == np.float32)
-
 input_mean = 127.5
 input_std = 127.5
 
-# Initialize frame rate calculation
-frame_rate_calc = 1
-freq = cv2.getTickFrequency()
+# Writes frames straight into the input tensor of whichever interpreter will run them
+preprocessor = Preprocessor(input_details[0], input_mean, input_std)
+
+# Vectorized detection post-processing.
+# tY has always been scaled with the horizontal FOV, keep it that way so the robot code doesn't change.
+# Results stay in use until the stream stage is done with them: one being made, one in each
+# queue and one each in publish and stream, so the ring holds one more than that
+postProcessor = PostProcessor(imW, imH, min_conf_threshold, xFov=xFov, yFov=xFov, ringSize=6)
+
+# Temperature, CPU frequency / throttling / load and memory, sampled once a second in the background
+telemetry = Telemetry(interval=1.0).start()
 
-# Initialize video stream & output mjpg stream
-videostream = VideoStream(resolution=(imW,imH),framerate=30).start()
-mjpgStream = MJPGHandler().start()
+# Steps inference rate and interpreter count down as the Pi heats up, before it throttles
+governor = ThermalGovernor(SimulatedTelemetry.parse(sim_temp) if sim_temp else telemetry)
+
+# Crops around the locked target instead of the full frame, see RoiSelector
+roiSelector = RoiSelector(imW, imH, width, height, fullEvery=roi_full_every) if use_roi else None
+
+# Initialize video stream & output mjpg stream.
+# Extra capture buffers so every frame in flight in the pipeline keeps its own buffer
+videostream = VideoStream(resolution=(imW,imH),framerate=30,buffers=12).start()
+mjpgStream = MJPGHandler(address=stream_address, maxFps=stream_fps, useAsyncio=stream_async, targetKbps=stream_kbps).start()
 time.sleep(1)
 
-#for frame1 in camera.capture_continuous(rawCapture, format="bgr",use_video_port=True):
-while True:
-
-    # Start timer (for calculating frame rate)
-    t1 = cv2.getTickCount()
-
-    # Grab frame from video stream
-    frame1 = videostream.read()
-
-    # Acquire frame and resize to expected shape [1xHxWx3]
-    frame = frame1.copy()
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    frame_resized = cv2.resize(frame_rgb, (width, height))
-    input_data = np.expand_dims(frame_resized, axis=0)
-
-    # Normalize pixel values if using a floating model (i.e. if model is non-quantized)
-    if floating_model:
-        input_data = (np.float32(input_data) - input_mean) / input_std
-        print("nonquant")
-
-    # Perform the actual detection by running the model with the image as input
-    interpreter.set_tensor(input_details[0]['index'],input_data)
-    interpreter.invoke()
-
-    # Retrieve detection results
-    boxes = interpreter.get_tensor(output_details[0]['index'])[0] # Bounding box coordinates of detected objects
-    classes = interpreter.get_tensor(output_details[1]['index'])[0] # Class index of detected objects
-    scores = interpreter.get_tensor(output_details[2]['index'])[0] # Confidence of detected objects
-    #num = interpreter.get_tensor(output_details[3]['index'])[0]  # Total number of detected objects (inaccurate and not needed)
-    
-    #reset robot list before next detection iteration
-    mainTgtList.clear()
-    
-    # Loop over all detections and draw detection box if confidence is above minimum threshold
-    mainTgtN = 0
-    altTgtN = 0
-    for i in range(len(scores)):
-        if ((scores[i] > min_conf_threshold) and (scores[i] <= 1.0)):
-
-            # Get bounding box coordinates and draw box
-            # Interpreter can return coordinates that are outside of image dimensions, need to force them to be within image using max() and min()
-            ymin = int(max(1,(boxes[i][0] * imH)))
-            xmin = int(max(1,(boxes[i][1] * imW)))
-            ymax = int(min(imH,(boxes[i][2] * imH)))
-            xmax = int(min(imW,(boxes[i][3] * imW)))
-           
-            tgtXCenter = xmin + ((xmax-xmin)/2.0)
-            tgtYCenter = ymin + ((ymax-ymin)/2.0)
-            
-            cv2.rectangle(frame, (xmin,ymin), (xmax,ymax), (10, 255, 0), 2)
-
-            # Draw label
-            object_name = labels[int(classes[i])] # Look up object name from "labels" array using class index
-            label = '%s: %d%%' % (object_name + " " + str(mainTgtN), int(scores[i]*100)) # Example: 'robot: 72%'  
-            labelSize, baseLine = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2) # Get font size
-            label_ymin = max(ymin, labelSize[1] + 10) # Make sure not to draw label too close to top of window
-            cv2.rectangle(frame, (xmin, label_ymin-labelSize[1]-10), (xmin+labelSize[0], label_ymin+baseLine-10), (255, 255, 255), cv2.FILLED) # Draw white box to put label text in
-            cv2.putText(frame, label, (xmin, label_ymin-7), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2) # Draw label text
-            
-            
-            
-             #Populating target list 
-            if(object_name == getTargetType()):
-
-                    tArea = ((xmax-xmin)*(ymax-ymin))
-                    confidence = int(scores[i]*100.0)
-                    tX = ((tgtXCenter - (imW/2.0))*((xFov/2.0)/(imW/2.0)))
-                    tY = ((tgtYCenter - (imH/2.0))*((xFov/2.0)/(imH/2.0)))
-
-                    mainTgtList.append({'tgtNum': mainTgtN, 'tA': tArea, 'tConf': confidence,
-                                      'tX': tX, 'tY': tY, 'xCenter':tgtXCenter, 'yCenter':tgtYCenter})
-
-                    mainTgtN += 1
-            else:
-                altTgtN += 1
-                    
-    
-    altTgts.putNumber('targetCount', altTgtN)
-
-    # Draw framerate in corner of frame and send to NT
-    cv2.putText(frame,'FPS: {0:.2f}'.format(frame_rate_calc),(20,40),cv2.FONT_HERSHEY_SIMPLEX,0.6,(255,255,0),1,cv2.LINE_AA)
-    statusTable.putNumber("FPS", frame_rate_calc)
-    tempC = PITemp.readTemp()
-    statusTable.putNumber("CPU Temp", tempC)
-    cv2.putText(frame,'{0:.1f}C'.format(tempC),(20,65),cv2.FONT_HERSHEY_SIMPLEX,0.6,(255,255,0),1,cv2.LINE_AA)
-
-
-    #populate NT with saved target list, reversed sort ensures sorting in descending order    
-    
-    if getTargetMode() == 0:
-        mainTgtList.sort(key=gettA, reverse=True)
-    elif getTargetMode() == 1:
-        mainTgtList.sort(key=gettX)
-    elif getTargetMode() == 2:
-        mainTgtList.sort(key=gettConf, reverse=True)
-
-    #if there are any main targets, take the highest priority target. draw target crosshair and populate NT data
-    if len(mainTgtList) > 0:
-        t = mainTgtList[0]
-        mainTgt.putValue("area", gettA(t)/(1000))
-        mainTgt.putNumber("conf", int(gettConf(t)))
-        mainTgt.putValue("tX", gettX(t))
-        mainTgt.putValue("tY", gettY(t))
-        
-        xCenter = int(getXCenter(t))
-        yCenter = int(getYCenter(t))
-
-        cv2.line(frame, (xCenter-4,yCenter), (xCenter+4,yCenter), (0, 255, 0), 2)
-        cv2.line(frame, (xCenter,yCenter-4), (xCenter,yCenter+4), (0, 255, 0), 2)
-
-    # All the results have been drawn on the frame, so it's time to display it.
-    #cv2.imshow('Object detector', frame)
-    mjpgStream.writeFrame(frame)
-
-    # Calculate framerate
-    t2 = cv2.getTickCount()
-    time1 = (t2-t1)/freq
-    frame_rate_calc= 1/time1
-
-    # Press 'q' to quit
-    if cv2.waitKey(1) == ord('q'):
-        break
+##PIPELINE STAGES
+# Each stage runs in its own thread, a job dict is handed from one stage to the next
+# (see DetectionStages for what each stage adds). stream only draws and encodes while someone is watching.
+# infer runs one worker per pooled interpreter, so results can come back out of order;
+# postprocess is ordered and drops any result older than one it already handled
+
+# Sequence number of the last camera frame we sent down the pipeline
+lastSeq = 0
+# Earliest time the next frame may go down the pipeline while the governor caps the rate
+nextCapture = 0.0
+
+def capture():
+    # Grab the next new frame from video stream, waiting for one if we already took the latest.
+    # The frame is not copied, it is held for us until the job is released
+    global lastSeq, nextCapture
+    maxFps = governor.maxFps
+    if maxFps > 0:
+        wait = nextCapture - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        nextCapture = time.monotonic() + 1.0 / maxFps
+    newFrame = videostream.readNew(lastSeq, timeout=1.0, hold=True)
+    if newFrame is None:
+        return None
+    lastSeq, frameTime, frame = newFrame
+    return {'seq': lastSeq, 'time': frameTime, 'frame': frame}
+
+# Match recording: raw camera frames and the annotated stream frames, each written to rotating
+# files from its own thread. status/record (set by the robot while enabled) starts and stops both.
+# The raw one takes every camera frame straight from the video stream, at camera rate
+rawRecorder = MatchRecorder(os.path.join(CWD_PATH, record_dir), name='raw', fps=30, source=videostream)
+annotatedRecorder = MatchRecorder(os.path.join(CWD_PATH, record_dir), name='annotated', fps=30)
+
+def recordChanged(source, key, value, isNew):
+    if value and not rawRecorder.recording:
+        rawRecorder.start()
+        annotatedRecorder.start()
+        # Keep annotated frames coming even with no one watching the stream
+        mjpgStream.subscribe()
+    elif not value and rawRecorder.recording:
+        rawRecorder.stop()
+        annotatedRecorder.stop()
+        mjpgStream.unsubscribe()
+
+# Don't overwrite a record the robot already set
+statusTable.setDefaultBoolean('record', False)
+statusTable.addEntryListener(recordChanged, immediateNotify=True, key='record', localNotify=True)
+
+# Latency histograms of every stage (capture is the wait for a camera frame, acquire the wait
+# for a free interpreter), plus invoke, draw and encode on their own. Published to status/timing every few seconds
+timing = Timing()
+TIMING_INTERVAL = 5
+
+# Full frame + tile passes on a time budget, see TiledInference
+tiler = TiledInference(interpreterPool, imW, imH, tileScale=tile_scale, budgetMs=tile_budget,
+                       minScore=min_conf_threshold) if use_tiles else None
+
+# Frames where nothing moved reuse the last detections, see MotionGate
+motionGate = MotionGate(maxAge=motion_max_age) if use_motion else None
+
+# Kalman tracks of the targets, corrected by publish and predicted for every camera frame, see TargetTracker
+tracker = TargetTracker(postProcessor, ntPublisher, timing=timing).start(videostream) if use_tracker else None
+
+# acquire / preprocess / infer / postprocess / publish / stream live in DetectionStages, shared with
+# the multi-camera script and the replay benchmark
+stages = DetectionStages(videostream, interpreterPool, preprocessor, postProcessor, targetConfig, ntPublisher, labels,
+                         telemetry=telemetry, onData=mjpgStream.writeData if stream_async else None, timing=timing,
+                         roi=roiSelector, tracker=tracker, motionGate=motionGate,
+                         tiler=tiler, mjpgStream=mjpgStream, recorder=annotatedRecorder)
+
+pipeline = Pipeline(queueSize=1, onRelease=stages.releaseJob, timing=timing, lateKey='tiled')
+pipeline.addSource('capture', capture)
+pipeline.addStage('acquire', stages.acquire)
+pipeline.addStage('preprocess', stages.preprocess)
+pipeline.addStage('infer', stages.infer, workers=interpreterPool.size)
+pipeline.addStage('postprocess', stages.postprocess, ordered=True)
+pipeline.addStage('publish', stages.publish)
+pipeline.addStage('stream', stages.stream)
+pipeline.start()
+##END PIPELINE STAGES
+
+# Main thread just reports pipeline stats (queue depths and per-stage timings) once a second,
+# and the latency histograms every TIMING_INTERVAL seconds
+ticks = 0
+try:
+    while True:
+        time.sleep(1)
+        ticks += 1
+        stages.publishStatus(pipeline.stats(), timing=ticks % TIMING_INTERVAL == 0)
+        ntPublisher.put('status/CPU Temp', telemetry.tempC, tolerance=0.1)
+        if governor.update():
+            interpreterPool.setLimit(governor.interpreters)
+        for key, value in governor.state().items():
+            ntPublisher.put('status/governor/' + key, value)
+        for key, value in telemetry.snapshot().items():
+            ntPublisher.put('status/telemetry/' + key, value, tolerance=0.01)
+        for recorder in (rawRecorder, annotatedRecorder):
+            for key, value in recorder.stats().items():
+                ntPublisher.put('status/recorder/' + recorder.name + '/' + key, value)
+        ntStats = ntPublisher.stats()
+        ntPublisher.put('status/nt/puts', ntStats['puts'])
+        ntPublisher.put('status/nt/bytes', ntStats['bytes'])
+        ntPublisher.put('status/nt/skipped', ntStats['skipped'])
+        ntPublisher.flush()
+except KeyboardInterrupt:
+    pass
 
 # Clean up
-cv2.destroyAllWindows()
+pipeline.stop()
+if tracker is not None:
+    tracker.stop()
+if tiler is not None:
+    tiler.stop()
+rawRecorder.stop()
+annotatedRecorder.stop()
 mjpgStream.stop()
 videostream.stop()
-
-
+telemetry.stop()
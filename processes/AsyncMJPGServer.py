@@ -0,0 +1,157 @@
+# asyncio MJPG + detection data server
+#
+# Drop-in replacement for ThreadedHTTPServer in MJPGHandler (serve_forever / shutdown /
+# server_close). Instead of one OS thread (and stack, and GIL contention with inference) per
+# viewer, every viewer is a coroutine on one event loop thread, all sending the same shared
+# JPEG bytes that MJPGHandler.writeFrame() encoded.
+#
+# Writes never block: each viewer's socket buffer is capped, and when a viewer falls behind
+# its coroutine waits in drain() while newer frames replace the ones it missed. A viewer that
+# can't drain within sendTimeout is dropped.
+#
+# Paths: /cam.mjpg (video), /cam.html (page), /data (detection data as server-sent events)
+
+import asyncio
+import json
+from threading import Event
+
+
+class AsyncMJPGServer:
+    """Streams the shared frames of an MJPGHandler to all viewers from one asyncio thread"""
+    def __init__(self, address, stream, maxFps=0, sendTimeout=2.0, maxBuffered=256*1024):
+        self.address = address
+        self.stream = stream
+        self.maxFps = maxFps
+        self.sendTimeout = sendTimeout
+        self.maxBuffered = maxBuffered
+
+        self.loop = None
+        self.frameEvent = None
+        self.done = Event()
+
+        # Detection data serialized once per update, (seq, bytes)
+        self.dataCache = (-1, b'')
+
+    def serve_forever(self):
+        # Run the event loop in the calling thread until shutdown()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.frameEvent = asyncio.Event()
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, self.address[0], self.address[1], reuse_address=True))
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            # Wake every viewer so it sees the stream stopped and closes its connection,
+            # only cancel the ones that don't finish in time
+            self.notify()
+            tasks = asyncio.all_tasks(self.loop)
+            if tasks:
+                self.loop.run_until_complete(asyncio.wait(tasks, timeout=self.sendTimeout))
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+            self.done.set()
+
+    def shutdown(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.done.wait(2.0)
+
+    def server_close(self):
+        pass
+
+    def frameReady(self):
+        # Called from the writer's thread, wakes every viewer on the loop thread
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.notify)
+
+    def notify(self):
+        # Viewers wait on the current event, swap in a fresh one before waking them
+        event = self.frameEvent
+        self.frameEvent = asyncio.Event()
+        event.set()
+
+    async def waitNext(self):
+        try:
+            await asyncio.wait_for(self.frameEvent.wait(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.sendTimeout)
+            # Skip the rest of the request headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.sendTimeout)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            path = parts[1].decode() if len(parts) > 1 else ''
+
+            writer.transport.set_write_buffer_limits(high=self.maxBuffered)
+            if path.endswith('.mjpg'):
+                await self.sendMJPG(writer)
+            elif path.endswith('.html'):
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n')
+                writer.write(b'<html><head></head><body><img src="/cam.mjpg"/></body></html>')
+                await writer.drain()
+            elif path.endswith('/data'):
+                await self.sendData(writer)
+            else:
+                writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError):
+            # Viewer went away or is too slow, drop it
+            pass
+        finally:
+            writer.close()
+
+    async def sendMJPG(self, writer):
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-type: multipart/x-mixed-replace; boundary=--jpgboundary\r\n\r\n')
+        minInterval = (1.0 / self.maxFps) if self.maxFps > 0 else 0.0
+        self.stream.clientStart(writer)
+        try:
+            await self.streamFrames(writer, minInterval)
+        finally:
+            self.stream.clientDone(writer)
+
+    async def streamFrames(self, writer, minInterval):
+        lastSeq = -1
+        while not self.stream.stopped:
+            seq, jpeg = self.stream.latest
+            if seq == lastSeq:
+                await self.waitNext()
+                continue
+            lastSeq = seq
+            writer.write(b'Content-type: image/jpeg\r\nContent-length: %d\r\n\r\n' % len(jpeg))
+            writer.write(jpeg)
+            writer.write(b'\r\n--jpgboundary\r\n')
+            self.stream.countSent(writer, len(jpeg))
+
+            # Returns right away unless this viewer's buffer is over maxBuffered.
+            # While it waits, newer frames replace the ones this viewer can't keep up with
+            await asyncio.wait_for(writer.drain(), self.sendTimeout)
+            if minInterval > 0:
+                await asyncio.sleep(minInterval)
+
+    async def sendData(self, writer):
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+        lastSeq = -1
+        while not self.stream.stopped:
+            seq, data = self.stream.latestData
+            if seq == lastSeq:
+                await self.waitNext()
+                continue
+            lastSeq = seq
+            writer.write(b'data: ' + self.encodeData(seq, data) + b'\n\n')
+            await asyncio.wait_for(writer.drain(), self.sendTimeout)
+
+    def encodeData(self, seq, data):
+        # JSON once per update no matter how many viewers
+        if self.dataCache[0] != seq:
+            self.dataCache = (seq, json.dumps(data).encode())
+        return self.dataCache[1]
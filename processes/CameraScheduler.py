@@ -0,0 +1,95 @@
+# Shares the interpreter pool between several cameras
+#
+# Every camera runs its own capture -> ... -> stream pipeline, but a frame may only go down it
+# while it holds one of `slots` inference slots (one per active interpreter). The slot is taken
+# by capture and given back once the frame's inference is done, so at most `slots` frames from
+# all cameras together are waiting on or running in an interpreter.
+#
+# When several cameras wait for a slot, stride scheduling picks which one goes: every grant
+# moves that camera's pass value forward by 1 / weight, and the waiting camera with the lowest
+# pass goes next. Over time each camera gets slots in proportion to its weight, without one
+# camera starving the other. A camera that comes back from idle starts at the current pass
+# so it can't burst through everything it "saved up".
+#
+# The camera facing the direction of travel can be favored: favor(name) gives it `ratio` times
+# the weight of the others. A weight of 0 only gets slots no other camera is waiting for.
+
+from threading import Condition
+
+
+class CameraScheduler:
+    """Weighted fair share of the inference slots between cameras"""
+    def __init__(self, names, slots=1, ratio=3.0):
+        self.names = list(names)
+        self.slots = slots
+        self.ratio = float(ratio)
+        self.inUse = 0
+        self.weights = {name: 1.0 for name in self.names}
+        self.passes = {name: 0.0 for name in self.names}
+        self.waiting = {name: 0 for name in self.names}
+        self.clock = 0.0
+        self.favored = ''
+        self.cond = Condition()
+
+        # Counters
+        self.grants = {name: 0 for name in self.names}
+
+    def setSlots(self, slots):
+        with self.cond:
+            self.slots = max(1, int(slots))
+            self.cond.notify_all()
+
+    def setWeight(self, name, weight):
+        with self.cond:
+            self.weights[name] = max(0.0, float(weight))
+            self.cond.notify_all()
+
+    def favor(self, name):
+        # Camera name gets ratio x the weight of every other one, '' (or an unknown name) is even
+        with self.cond:
+            self.favored = name if name in self.weights else ''
+            for camera in self.names:
+                self.weights[camera] = self.ratio if camera == self.favored else 1.0
+            self.cond.notify_all()
+
+    def pick(self):
+        # Waiting camera with the lowest pass, weighted ones before weight 0. None if none wait
+        best = None
+        for name in self.names:
+            if not self.waiting[name]:
+                continue
+            key = (self.weights[name] == 0, self.passes[name])
+            if best is None or key < best[0]:
+                best = (key, name)
+        return best[1] if best is not None else None
+
+    def acquire(self, name, timeout=None):
+        # Wait for an inference slot for camera name, False if none was granted within timeout
+        with self.cond:
+            if not self.waiting[name]:
+                self.passes[name] = max(self.passes[name], self.clock)
+            self.waiting[name] += 1
+            try:
+                granted = self.cond.wait_for(lambda: self.inUse < self.slots and self.pick() == name, timeout)
+            finally:
+                self.waiting[name] -= 1
+            if not granted:
+                # Someone else may be next now
+                self.cond.notify_all()
+                return False
+            self.inUse += 1
+            self.clock = self.passes[name]
+            self.passes[name] += 1.0 / self.weights[name] if self.weights[name] > 0 else 1.0
+            self.grants[name] += 1
+            self.cond.notify_all()
+            return True
+
+    def release(self):
+        with self.cond:
+            self.inUse = max(0, self.inUse - 1)
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {'slots': self.slots, 'inUse': self.inUse, 'favored': self.favored,
+                    'grants': dict(self.grants), 'weights': dict(self.weights)}
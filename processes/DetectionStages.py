@@ -0,0 +1,322 @@
+# Detection pipeline stages shared by the live webcam script and the replay benchmark
+#
+# Each stage takes the job dict from the stage before it and returns it with more filled in:
+# {'seq', 'time', 'frame'} from the capture source, + 'interpreter' from acquire (holding the input
+# after preprocess) + 'roi' (crop the model ran on, None for the full frame) from preprocess, + 'boxes'/'classes'/'scores' from infer, + 'detections' (Detections columns)
+# /'altTgtN' from postprocess, + 'tempC'/'mainCenter' from publish. Frames the motion gate lets reuse the last
+# results get 'reused' from acquire instead of an interpreter, skip infer and get the last 'detections'.
+# Frames picked for a tiled pass get 'tiled' from preprocess, infer writes the inputs itself. A
+# tiled pass takes longer than a full frame, so newer frames can overtake it: the pipeline lets
+# it through the ordered postprocess anyway (lateKey='tiled'), and postprocess marks it 'late'.
+# Returning None drops the job. releaseJob() is the Pipeline's onRelease, it gives back the
+# camera buffer and the interpreter of every job leaving the pipeline. stream() is the last stage
+# of the live scripts, publishStatus() reports a pipeline's stats from their main loop.
+
+import time
+import numpy as np
+import cv2
+from processes.TargetTable import TargetTable
+
+
+class DetectionStages:
+    """acquire / preprocess / infer / postprocess / publish / stream for one camera, plus drawing the results"""
+    def __init__(self, source, interpreterPool, preprocessor, postProcessor, targetConfig, ntPublisher, labels,
+                 telemetry=None, onData=None, timing=None, roi=None, tracker=None, motionGate=None,
+                 tiler=None, mjpgStream=None, recorder=None):
+        # source is the VideoStream (anything with release(seq)) the jobs' frames came from.
+        # onData(dict) gets the main target data of every published frame, e.g. MJPGHandler.writeData.
+        # timing (LatencyHistogram.Timing) gets the invoke time on its own, apart from the infer stage.
+        # With a roi (RoiSelector) frames run on a crop around the last main target when there is one.
+        # With a tracker (TargetTracker) every frame's targets correct its tracks, and the tracker
+        # publishes mainTgt at camera rate instead of this stage publishing it once per inference.
+        # With a motionGate (MotionGate) frames where nothing changed reuse the last results.
+        # With a tiler (TiledInference) some full frames get a tiled pass as its time budget allows.
+        # mjpgStream (MJPGHandler) is where stream() sends the annotated frames, recorder
+        # (MatchRecorder) gets a copy of each
+        self.source = source
+        self.interpreterPool = interpreterPool
+        self.preprocessor = preprocessor
+        self.postProcessor = postProcessor
+        self.targetConfig = targetConfig
+        self.ntPublisher = ntPublisher
+        self.labels = labels
+        self.telemetry = telemetry
+        self.onData = onData
+        self.timing = timing
+        self.roi = roi
+        self.tracker = tracker
+        self.motionGate = motionGate
+        self.tiler = tiler
+        self.mjpgStream = mjpgStream
+        self.recorder = recorder
+
+        # Detections of the last inferred frame, for frames that reuse them, and the frames last
+        # sent to inference and last postprocessed
+        self.lastDetections = None
+        self.lastAltTgtN = 0
+        self.inferSeq = 0
+        self.detectionsSeq = 0
+
+        # Frames dropped because no interpreter came free in time
+        self.acquireTimeouts = 0
+
+        # Whether the last published frame had a main target
+        self.hadMain = False
+
+        # Targets of the frame being published, one preallocated array per field (tgtNum, tA, tConf,
+        # tX, tY, xCenter, yCenter), refilled every frame. Only the publish stage touches it
+        self.targetTable = TargetTable(maxTargets=16)
+
+        # Frame the stream is drawn on when it is sent scaled down, reused every frame
+        self.streamFrame = None
+
+        # End-to-end frame rate, set by publishStatus()
+        self.fps = 1
+
+    def acquire(self, job):
+        # Check out the interpreter that will run this frame. Its own stage, so the wait for a
+        # free interpreter doesn't show up as preprocessing time.
+        # Frames the motion gate lets reuse the last results don't need one
+        if self.motionGate is not None and not self.motionGate.check(job['frame'], job['time']):
+            # Until the frame being reused comes out of inference this one would overtake it
+            # and make the ordered postprocess drop it as stale, and there's nothing to reuse yet
+            if self.detectionsSeq != self.inferSeq:
+                self.motionGate.drop()
+                return None
+            job['reused'] = True
+            job['roi'] = None
+            return job
+        interpreter = self.interpreterPool.acquire(timeout=1.0)
+        if interpreter is None:
+            self.acquireTimeouts += 1
+            if self.motionGate is not None:
+                self.motionGate.reset()
+            return None
+        self.inferSeq = job['seq']
+        job['interpreter'] = interpreter
+        return job
+
+    def preprocess(self, job):
+        # Resize and color convert the frame straight into its interpreter's input tensor [1xHxWx3]
+        if job.get('reused'):
+            return job
+        interpreter = job['interpreter']
+        frame = job['frame']
+        roi = self.roi.next(job['seq']) if self.roi is not None else None
+        job['roi'] = roi
+        if roi is None and self.tiler is not None and self.tiler.nextPass(job['seq']):
+            # infer fills the inputs tile by tile
+            job['tiled'] = True
+            return job
+        if roi is not None:
+            # A view of the crop, Preprocessor resizes it like any other frame
+            x0, y0, w, h = roi
+            frame = frame[y0:y0+h, x0:x0+w]
+        self.preprocessor.into(frame, interpreter)
+        return job
+
+    def infer(self, job):
+        # Perform the actual detection by running the model on the input preprocess already wrote
+        if job.get('reused'):
+            return job
+        interpreter = job.pop('interpreter')
+        try:
+            t0 = time.perf_counter()
+            if job.get('tiled'):
+                # Full frame and every tile, already merged and in full frame coordinates
+                job['boxes'], job['classes'], job['scores'] = self.tiler.run(job['frame'], interpreter)
+                if self.timing is not None:
+                    self.timing.record('tiled', (time.perf_counter() - t0) * 1000.0)
+                return job
+            interpreter.invoke()
+            ms = (time.perf_counter() - t0) * 1000.0
+            if self.timing is not None:
+                self.timing.record('invoke', ms)
+            if self.tiler is not None and job['roi'] is None:
+                self.tiler.recordFull(ms)
+            outputs = self.interpreterPool.getOutputs(interpreter)
+        finally:
+            self.interpreterPool.release(interpreter)
+
+        # Retrieve detection results
+        job['boxes'] = outputs[0][0] # Bounding box coordinates of detected objects
+        job['classes'] = outputs[1][0] # Class index of detected objects
+        job['scores'] = outputs[2][0] # Confidence of detected objects
+        #num = outputs[3][0]  # Total number of detected objects (inaccurate and not needed)
+        return job
+
+    def postprocess(self, job):
+        if job.get('reused'):
+            job['detections'] = self.lastDetections
+            job['altTgtN'] = self.lastAltTgtN
+            return job
+
+        # Boxes found in a crop are relative to the crop, map them back onto the full frame
+        if job.get('roi') is not None:
+            self.roi.mapBoxes(job['boxes'], job['roi'])
+
+        # Threshold, scale, clip and measure every detection at once
+        d = self.postProcessor.process(job['boxes'], job['classes'], job['scores'], self.targetConfig.tgtClassId)
+
+        job['detections'] = d
+        job['altTgtN'] = d.count - d.targetCount
+        if job['seq'] < self.detectionsSeq:
+            # Tiled pass newer frames overtook, their results stay the ones to reuse
+            job['late'] = True
+            return job
+        self.lastDetections = d
+        self.lastAltTgtN = job['altTgtN']
+        self.detectionsSeq = job['seq']
+        return job
+
+    def publish(self, job):
+        ntPublisher = self.ntPublisher
+        targetTable = self.targetTable
+        job['tempC'] = self.telemetry.tempC if self.telemetry is not None else 0.0
+
+        #if there are any main targets, take the highest priority target and populate NT data
+        d = job['detections']
+        t = targetTable.fill(d).select(self.targetConfig.tgtMode)
+        job['mainCenter'] = None
+        if self.tracker is not None and not job.get('late'):
+            # Late tiled passes are older than what the tracks already saw, they'd pull them back
+            n = targetTable.count
+            boxes = (targetTable.xmin[:n], targetTable.ymin[:n], targetTable.xmax[:n], targetTable.ymax[:n])
+            self.tracker.correct(job['time'], np.column_stack(boxes), targetTable.tConf[:n], t)
+        if t >= 0:
+            job['mainCenter'] = (targetTable.xCenter[t], targetTable.yCenter[t])
+        if job.get('late') and (t < 0 or self.hadMain):
+            # The newer frames' results are already out. A late tiled pass only stands in for them
+            # on NT when it found a main target they didn't (one too far away for the full frame),
+            # it never moves the tracks or the crop back to its older frame
+            return job
+        self.hadMain = t >= 0
+
+        ntPublisher.put('targets/altTgts/targetCount', job['altTgtN'])
+        # Send framerate to NT, temperature is sampled in the background and sent once a second
+        ntPublisher.put('status/FPS', self.fps, tolerance=0.05)
+        if t >= 0 and self.tracker is None:
+            ntPublisher.put('targets/mainTgt/area', targetTable.tA[t]/(1000))
+            ntPublisher.put('targets/mainTgt/conf', targetTable.tConf[t])
+            ntPublisher.put('targets/mainTgt/tX', targetTable.tX[t])
+            ntPublisher.put('targets/mainTgt/tY', targetTable.tY[t])
+        if self.roi is not None and not job.get('late'):
+            # Where the next crops go, or back to the full frame if the target is gone
+            self.roi.update(job['seq'], (int(targetTable.xmin[t]), int(targetTable.ymin[t]), int(targetTable.xmax[t]),
+                                         int(targetTable.ymax[t])) if t >= 0 else None)
+
+        # Send this frame's NT updates in one go
+        ntPublisher.flush()
+
+        # Same main target data for /data stream viewers
+        if self.onData is not None:
+            if t >= 0:
+                self.onData({'seq': job['seq'], 'tX': float(targetTable.tX[t]), 'tY': float(targetTable.tY[t]),
+                             'area': float(targetTable.tA[t])/1000, 'conf': int(targetTable.tConf[t]),
+                             'targets': d.targetCount, 'altTargets': job['altTgtN']})
+            else:
+                self.onData({'seq': job['seq'], 'targets': 0, 'altTargets': job['altTgtN']})
+        return job
+
+    def stream(self, job):
+        # Only draw and encode while someone is watching and the stream wants another frame
+        mjpgStream = self.mjpgStream
+        if not mjpgStream.wantsFrame():
+            return job
+
+        # Draw at the size the stream is sent at, on a scaled down copy if the stream is scaled down
+        t0 = time.perf_counter()
+        frame = job['frame']
+        scale = mjpgStream.scale
+        if scale < 1.0:
+            size = (int(self.postProcessor.imW * scale), int(self.postProcessor.imH * scale))
+            if self.streamFrame is None or self.streamFrame.shape[1::-1] != size:
+                self.streamFrame = np.empty((size[1], size[0], 3), np.uint8)
+            cv2.resize(frame, size, dst=self.streamFrame, interpolation=cv2.INTER_AREA)
+            frame = self.streamFrame
+        self.annotate(frame, job, scale)
+        t1 = time.perf_counter()
+
+        # All the results have been drawn on the frame, so it's time to display it.
+        mjpgStream.writeFrame(frame, scaled=True)
+        if self.recorder is not None:
+            self.recorder.write(frame, job['time'])
+        if self.timing is not None:
+            self.timing.record('draw', (t1 - t0) * 1000.0)
+            self.timing.record('encode', (time.perf_counter() - t1) * 1000.0)
+        return job
+
+    def publishStatus(self, pipelineStats, timing=False):
+        # Pipeline stats (queue depths and per-stage timings) and the stats of the stream and every
+        # optional part, plus the latency histograms if timing is set. Not flushed
+        ntPublisher = self.ntPublisher
+        # End-to-end framerate is the rate frames come out of publish
+        self.fps = pipelineStats['publish']['fps']
+        for name, stageStats in pipelineStats.items():
+            ntPublisher.put('status/pipeline/' + name + 'Ms', stageStats['emaMs'], tolerance=0.1)
+            ntPublisher.put('status/pipeline/' + name + 'Queue', stageStats['queueDepth'])
+            ntPublisher.put('status/pipeline/' + name + 'Dropped', stageStats['dropped'] + stageStats['stale'] + stageStats['rejected'])
+        ntPublisher.put('status/pipeline/acquireTimeouts', self.acquireTimeouts)
+        if self.mjpgStream is not None:
+            for key, value in self.mjpgStream.streamStats().items():
+                ntPublisher.put('status/stream/' + key, value, tolerance=0.5)
+        for table, part, tolerance in (('roi', self.roi, None), ('tiles', self.tiler, 0.1),
+                                       ('motion', self.motionGate, 0.01), ('tracker', self.tracker, None)):
+            if part is not None:
+                for key, value in part.stats().items():
+                    ntPublisher.put('status/' + table + '/' + key, value, tolerance=tolerance)
+        if timing and self.timing is not None:
+            self.timing.publish(ntPublisher, 'status/timing')
+
+    def annotate(self, frame, job, scale=1.0):
+        # Draw detection boxes, labels, framerate, temperature and the target crosshair.
+        # Coordinates are in camera pixels, scale maps them onto a scaled down frame
+        d = job['detections']
+        thick = max(1, int(round(2 * scale)))
+        fontScale = 0.7 * scale
+        for i in range(d.count):
+            xmin, ymin = int(d.xmin[i] * scale), int(d.ymin[i] * scale)
+            xmax, ymax = int(d.xmax[i] * scale), int(d.ymax[i] * scale)
+            label = '%s: %d%%' % (self.labels[d.classId[i]] + " " + str(d.tgtNum[i]), d.conf[i]) # Example: 'robot: 72%'
+            cv2.rectangle(frame, (xmin,ymin), (xmax,ymax), (10, 255, 0), thick)
+            labelSize, baseLine = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, fontScale, thick) # Get font size
+            pad = int(10 * scale)
+            label_ymin = max(ymin, labelSize[1] + pad) # Make sure not to draw label too close to top of window
+            cv2.rectangle(frame, (xmin, label_ymin-labelSize[1]-pad), (xmin+labelSize[0], label_ymin+baseLine-pad), (255, 255, 255), cv2.FILLED) # Draw white box to put label text in
+            cv2.putText(frame, label, (xmin, label_ymin-int(7 * scale)), cv2.FONT_HERSHEY_SIMPLEX, fontScale, (0, 0, 0), thick) # Draw label text
+
+        # Draw framerate and temperature in corner of frame
+        cv2.putText(frame,'FPS: {0:.2f}'.format(self.fps),(20,40),cv2.FONT_HERSHEY_SIMPLEX,0.6,(255,255,0),1,cv2.LINE_AA)
+        cv2.putText(frame,'{0:.1f}C'.format(job['tempC']),(20,65),cv2.FONT_HERSHEY_SIMPLEX,0.6,(255,255,0),1,cv2.LINE_AA)
+
+        # Crop the model ran on
+        roi = job.get('roi')
+        if roi is not None:
+            x0, y0, w, h = roi
+            cv2.rectangle(frame, (int(x0 * scale), int(y0 * scale)), (int((x0 + w) * scale), int((y0 + h) * scale)), (255, 128, 0), 1)
+
+        mainCenter = job['mainCenter']
+        if mainCenter is not None:
+            xCenter = int(mainCenter[0] * scale)
+            yCenter = int(mainCenter[1] * scale)
+            cv2.line(frame, (xCenter-4,yCenter), (xCenter+4,yCenter), (0, 255, 0), thick)
+            cv2.line(frame, (xCenter,yCenter-4), (xCenter,yCenter+4), (0, 255, 0), thick)
+
+    def restart(self):
+        # For a source that numbers its frames from 1 again, nothing after this is late
+        self.inferSeq = 0
+        self.detectionsSeq = 0
+
+    def releaseJob(self, job):
+        # Every job leaving the pipeline (finished or dropped) gives its camera buffer back,
+        # and its interpreter if it was dropped before inference
+        self.source.release(job['seq'])
+        interpreter = job.pop('interpreter', None)
+        if interpreter is not None:
+            self.interpreterPool.release(interpreter)
+        if job['seq'] == self.inferSeq and 'detections' not in job and not job.get('reused'):
+            # The frame sent to inference never got postprocessed (dropped from a queue or infer
+            # failed), stop waiting on its results and make the next frame run
+            self.inferSeq = self.detectionsSeq
+            if self.motionGate is not None:
+                self.motionGate.reset()
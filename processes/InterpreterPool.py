@@ -0,0 +1,121 @@
+# Pool of TFLite interpreters for running inference on several CPU cores at once
+#
+# One Interpreter can only run one invoke() at a time, so with a small model a quad-core Pi
+# leaves cores idle. The pool keeps N interpreters for the same model and hands them out
+# round-robin (the interpreter that has been free the longest goes next), so N inference
+# workers can each run a frame in parallel.
+#
+# setLimit() caps how many of them are handed out (e.g. to cool down a hot Pi), the others are
+# parked as they come free and handed out again when the limit goes back up.
+
+import os
+import time
+from queue import Queue, Empty
+from threading import Lock
+import numpy as np
+
+
+class InterpreterPool:
+    """Fixed set of interpreters for one model, shared by the inference workers"""
+    def __init__(self, makeInterpreter, size=1, numThreads=None):
+        # makeInterpreter(numThreads) must build a new Interpreter for the model
+        self.size = max(1, int(size))
+        self.numThreads = numThreads
+        self.interpreters = []
+        self.free = Queue()
+        for n in range(self.size):
+            interpreter = makeInterpreter(numThreads)
+            interpreter.allocate_tensors()
+            self.interpreters.append(interpreter)
+            self.free.put(interpreter)
+
+        # Interpreters held back by setLimit()
+        self.limit = self.size
+        self.parked = []
+        self.lock = Lock()
+
+        # Every interpreter runs the same model, so they all share these
+        self.input_details = self.interpreters[0].get_input_details()
+        self.output_details = self.interpreters[0].get_output_details()
+
+    @classmethod
+    def auto(cls, makeInterpreter, cores=None, trials=5):
+        # Pick pool size and threads per interpreter automatically.
+        # Every way of splitting the cores evenly between interpreters is timed on a blank
+        # input and the split with the best estimated frames per second wins.
+        cores = cores or os.cpu_count() or 1
+        best = None
+        for numThreads in range(1, cores + 1):
+            if cores % numThreads != 0:
+                continue
+            interpreter = makeInterpreter(numThreads)
+            interpreter.allocate_tensors()
+            details = interpreter.get_input_details()[0]
+            blank = np.zeros(details['shape'], dtype=details['dtype'])
+
+            # First invoke is always slow, don't count it
+            interpreter.set_tensor(details['index'], blank)
+            interpreter.invoke()
+            t0 = time.perf_counter()
+            for n in range(trials):
+                interpreter.set_tensor(details['index'], blank)
+                interpreter.invoke()
+            latency = (time.perf_counter() - t0) / trials
+
+            size = cores // numThreads
+            rate = size / latency
+            if best is None or rate > best[0]:
+                best = (rate, size, numThreads)
+
+        print("interpreter pool: %d x %d threads (~%.1f fps)" % (best[1], best[2], best[0]))
+        return cls(makeInterpreter, size=best[1], numThreads=best[2])
+
+    def acquire(self, timeout=None):
+        # Wait for the next free interpreter, None if none came free within timeout
+        try:
+            return self.free.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def release(self, interpreter):
+        with self.lock:
+            # Park it instead if more are out than the limit allows
+            if self.size - len(self.parked) > self.limit:
+                self.parked.append(interpreter)
+                return
+        self.free.put(interpreter)
+
+    def setLimit(self, limit):
+        # Hand out at most limit interpreters at once (0 = all of them)
+        with self.lock:
+            self.limit = self.size if limit <= 0 else min(int(limit), self.size)
+            while self.parked and self.size - len(self.parked) < self.limit:
+                self.free.put(self.parked.pop())
+        # Park free ones now, busy ones get parked when they are released
+        while True:
+            with self.lock:
+                if self.size - len(self.parked) <= self.limit:
+                    return
+            try:
+                interpreter = self.free.get_nowait()
+            except Empty:
+                return
+            self.release(interpreter)
+
+    @property
+    def active(self):
+        return self.size - len(self.parked)
+
+    def getOutputs(self, interpreter):
+        # Copies of every output tensor after an invoke()
+        return [interpreter.get_tensor(detail['index']) for detail in self.output_details]
+
+    def invoke(self, inputData):
+        # Run one frame on the next free interpreter, returns the tensors of every output
+        interpreter = self.acquire()
+        try:
+            interpreter.set_tensor(self.input_details[0]['index'], inputData)
+            interpreter.invoke()
+            return self.getOutputs(interpreter)
+        finally:
+            self.release(interpreter)
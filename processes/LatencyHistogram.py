@@ -0,0 +1,87 @@
+# Fixed-bucket latency histograms
+#
+# Recording a sample is one bisect and a counter increment, no per-frame lists or prints, so
+# every stage can be timed all the time. Percentiles come from the bucket counts (accurate to
+# the bucket width, about 12% with the default log spaced buckets) and are published at a low
+# rate, each window starting from zero so they show how the pipeline is doing right now.
+# The EMA carries over between windows.
+
+from bisect import bisect_right
+from threading import Lock
+import numpy as np
+
+# Bucket upper edges in ms, log spaced from 0.05ms to 5s
+DEFAULT_EDGES = tuple(float(edge) for edge in np.geomspace(0.05, 5000.0, 97))
+
+
+class LatencyHistogram:
+    """Counts of latency samples per fixed bucket, plus an EMA and the max"""
+    def __init__(self, edges=DEFAULT_EDGES, alpha=0.1):
+        self.edges = edges
+        self.alpha = alpha
+        # One more bucket than edges for anything slower than the last edge
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.emaMs = 0.0
+        self.maxMs = 0.0
+        self.lock = Lock()
+
+    def record(self, ms):
+        with self.lock:
+            self.counts[bisect_right(self.edges, ms)] += 1
+            self.emaMs = ms if self.emaMs == 0.0 else (1 - self.alpha) * self.emaMs + self.alpha * ms
+            self.count += 1
+            if ms > self.maxMs:
+                self.maxMs = ms
+
+    def percentile(self, p):
+        # Upper edge of the bucket holding the p-th percentile sample (the max for the last bucket)
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        total = 0
+        for bucket, n in enumerate(self.counts):
+            total += n
+            if total >= rank and n > 0:
+                return min(self.edges[bucket], self.maxMs) if bucket < len(self.edges) else self.maxMs
+        return self.maxMs
+
+    def stats(self, reset=False):
+        # EMA, p50/p95/p99 and max of the window, reset=True starts a new window
+        with self.lock:
+            stats = {'emaMs': self.emaMs, 'p50Ms': self.percentile(50), 'p95Ms': self.percentile(95),
+                     'p99Ms': self.percentile(99), 'maxMs': self.maxMs, 'count': self.count}
+            if reset:
+                self.counts = [0] * len(self.counts)
+                self.count = 0
+                self.maxMs = 0.0
+            return stats
+
+
+class Timing:
+    """Named latency histograms, recorded from any thread and published together at a low rate"""
+    def __init__(self, edges=DEFAULT_EDGES):
+        self.edges = edges
+        self.histograms = {}
+        self.lock = Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, LatencyHistogram(self.edges))
+        return histogram
+
+    def record(self, name, ms):
+        self.histogram(name).record(ms)
+
+    def stats(self, reset=False):
+        return {name: histogram.stats(reset) for name, histogram in list(self.histograms.items())}
+
+    def publish(self, ntPublisher, prefix='status/timing', reset=True):
+        # One subtable per timer, e.g. status/timing/infer/p95Ms. Returns the stats it sent
+        stats = self.stats(reset)
+        for name, values in stats.items():
+            for key, value in values.items():
+                ntPublisher.put(prefix + '/' + name + '/' + key, value, tolerance=0.05)
+        return stats
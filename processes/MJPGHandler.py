@@ -2,59 +2,198 @@
 # THIS IS YOUR OUTPUT VIDEO STREAM WITH ALL POST PROCESSING
 
 # Source - Adrian Rosebrock, PyImageSearch: https://www.pyimagesearch.com/2015/12/28/increasing-raspberry-pi-fps-with-python-and-opencv/ & @n3wtron - https://gist.github.com/n3wtron/4624820s
+#
+# Each frame is JPEG encoded once, when writeFrame() is called, and the same bytes are sent to
+# every connected viewer. Viewer threads sleep on a condition variable until a frame with a newer
+# sequence number exists and then send the newest one, so idle viewers use no CPU.
+#
+# The HTTP server runs serve_forever() in a background thread and handles every viewer in its
+# own thread. Each viewer can be capped to a max frame rate (frames in between are skipped for
+# that viewer), and a viewer that can't take a frame within sendTimeout is dropped.
+# With useAsyncio=True an AsyncMJPGServer serves every viewer from one event loop thread instead.
+#
+# With a targetKbps, the bytes sent to each viewer are counted and a StreamRateControl lowers
+# JPEG quality, output scale and frame rate whenever the stream goes over budget.
+#
+# wantsFrame() tells the caller whether a frame would be used right now (someone is watching
+# and the stream frame rate allows one), so annotation and encoding can be skipped entirely
+# when nobody is.
 
-from threading import Thread
+from threading import Thread, Condition, Lock
 from http.server import BaseHTTPRequestHandler,HTTPServer
 from socketserver import ThreadingMixIn
+import socket
+import time
 import numpy as np
 import cv2
+from processes.AsyncMJPGServer import AsyncMJPGServer
+from processes.StreamRateControl import StreamRateControl
 
-processedGrabbed = True
 blankFrame = np.ones((640,480,1),np.uint8)*135
-blankFrame2 = np.ones((640,480,1),np.uint8)*255
-processedFrame = blankFrame
 #server = None
 class MJPGHandler:
     """Camera object that controls video streaming from the Picamera"""
-    def __init__(self):
-        # Initialize the PiCamera and the camera image stream
-        # Read frame from the stream
-        
+    def __init__(self, address=('0.0.0.0', 8080), maxFps=0, sendTimeout=2.0, useAsyncio=False, targetKbps=0):
+        # address the server binds to, ('0.0.0.0', port) listens on every interface.
+        # maxFps caps the frame rate sent to each viewer (0 = no cap),
+        # sendTimeout drops a viewer that can't take a frame in that many seconds.
+        # useAsyncio serves all viewers from one asyncio thread instead of a thread per viewer.
+        # targetKbps adapts quality / scale / frame rate to stay under that bitrate (0 = off)
+        self.maxFps = maxFps
+        self.sendTimeout = sendTimeout
+
+        # Bytes sent per viewer since the last rate update, and the resulting bytes/sec
+        self.rateControl = StreamRateControl(targetKbps) if targetKbps > 0 else None
+        self.sentLock = Lock()
+        self.sentBytes = {}
+        self.clientRates = {}
+        self.clients = set()
+        # Other consumers of the annotated frames (e.g. a recorder), counted like viewers
+        self.subscribers = 0
+        self.rateTime = time.monotonic()
+        # When the next frame is due at the stream frame rate. Frames are scheduled against it
+        # rather than the time since the last one, so jitter doesn't make every other frame early
+        self.nextEncode = 0.0
+
         # Variable to control when the camera is stopped
         self.stopped = False
         self.grabbed, self.frame = True, blankFrame
-        
-        #IP ADDRESS WILL HAVE TO BE CHANGED TO ADDRESS ON ROBOT
-        self.server = ThreadedHTTPServer(('192.168.1.199', 8080), CamHandler)
-        print("server started at http://192.168.1.199:8080/cam.html")        
-        
+
+        # Latest encoded frame shared by all viewers, seq goes up by one per writeFrame()
+        self.cond = Condition()
+        self.seq = 0
+        self.jpeg = self.encode(blankFrame)
+        # Same (seq, jpeg) as one tuple for readers that don't take the lock
+        self.latest = (self.seq, self.jpeg)
+
+        # Latest detection data, (seq, dict), streamed on /data by the asyncio server
+        self.latestData = (0, {})
+
+        if useAsyncio:
+            self.server = AsyncMJPGServer(address, self, maxFps=maxFps, sendTimeout=sendTimeout)
+        else:
+            self.server = ThreadedHTTPServer(address, CamHandler)
+            self.server.stream = self
+        # Hook for servers that need to be told about new frames (the asyncio one)
+        self.onFrame = getattr(self.server, 'frameReady', None)
+        print("server started at http://%s:%d/cam.html" % address)
 
     def start(self):
-        # Start the thread that reads frames from the video stream
-        Thread(target=self.update,args=()).start()
+        # Serve viewers from a background thread until stop()
+        Thread(target=self.server.serve_forever,args=(),daemon=True).start()
         return self
 
+    def encode(self, frame, scaled=False):
+        rc = self.rateControl
+        if rc is None:
+            return cv2.imencode('.jpg', frame)[1].tobytes()
+        # Smaller and lower quality encodes when over budget, also cheaper on the CPU
+        if rc.scale < 1.0 and not scaled:
+            frame = cv2.resize(frame, None, fx=rc.scale, fy=rc.scale, interpolation=cv2.INTER_AREA)
+        return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, rc.quality])[1].tobytes()
+
+    @property
+    def scale(self):
+        # Scale frames are streamed at, draw at this size to avoid annotating pixels nobody sees
+        return self.rateControl.scale if self.rateControl is not None else 1.0
+
+    def hasViewers(self):
+        return len(self.clients) > 0 or self.subscribers > 0
+
+    def subscribe(self):
+        self.subscribers += 1
+
+    def unsubscribe(self):
+        self.subscribers = max(0, self.subscribers - 1)
+
+    def wantsFrame(self):
+        # True if a frame written now would be used: someone is watching and the stream
+        # frame rate allows another one
+        self.updateRate(time.monotonic())
+        if not self.hasViewers():
+            return False
+        if self.rateControl is not None:
+            return self.isDue(time.monotonic())
+        return True
+
+    def isDue(self, now):
+        # A quarter of a frame interval early still counts as on time
+        return now >= self.nextEncode - 0.25 / self.rateControl.fps
 
-    def update(self):
-        # Keep looping indefinitely until the thread is stopped
-        while True:
-            print ("calling update")
-            # If the camera is stopped, stop the thread
-            if self.stopped:
+    def writeFrame(self, frameIn, scaled=False):
+        # scaled=True means frameIn is already at stream scale
+        now = time.monotonic()
+        self.updateRate(now)
+        if self.rateControl is not None:
+            # Skip the frame entirely if it comes sooner than the current stream frame rate allows
+            if not self.isDue(now):
                 return
-            #print("request handled")
-            # Otherwise, grab the next frame from the stream
-            self.server.handle_request()
-                
-            
-
-    def writeFrame(self, frameIn):
-        #print("frame written")
-        self.frame = frameIn
-        global processedFrame
-        processedFrame = frameIn
-
-        
+            # Keep the cadence, but after a gap start again from now instead of catching up
+            self.nextEncode = max(self.nextEncode + 1.0 / self.rateControl.fps, now)
+
+        # Encode once here, every viewer gets these same bytes
+        jpeg = self.encode(frameIn, scaled)
+        with self.cond:
+            self.frame = frameIn
+            self.jpeg = jpeg
+            self.seq += 1
+            self.latest = (self.seq, jpeg)
+            self.cond.notify_all()
+        if self.onFrame is not None:
+            self.onFrame()
+
+    def writeData(self, data):
+        # Share detection data (a JSON serializable dict) with /data viewers
+        self.latestData = (self.latestData[0] + 1, data)
+        if self.onFrame is not None:
+            self.onFrame()
+
+    def clientStart(self, client):
+        with self.sentLock:
+            self.clients.add(client)
+
+    def countSent(self, client, nBytes):
+        # Viewers report what they sent, client is any key unique to the viewer
+        with self.sentLock:
+            self.sentBytes[client] = self.sentBytes.get(client, 0) + nBytes
+
+    def clientDone(self, client):
+        with self.sentLock:
+            self.clients.discard(client)
+            self.sentBytes.pop(client, None)
+            self.clientRates.pop(client, None)
+
+    def updateRate(self, now):
+        # About once a second, turn the byte counts into rates and let the rate control adapt
+        elapsed = now - self.rateTime
+        if elapsed < 1.0:
+            return
+        with self.sentLock:
+            self.clientRates = {client: n / elapsed for client, n in self.sentBytes.items()}
+            for client in self.sentBytes:
+                self.sentBytes[client] = 0
+        self.rateTime = now
+        if self.rateControl is not None:
+            self.rateControl.update(sum(self.clientRates.values()))
+
+    def streamStats(self):
+        # Total and per viewer send rate in kbit/s plus the current stream settings
+        rates = list(self.clientRates.values())
+        stats = {'clients': len(self.clients), 'kbps': sum(rates) * 8 / 1000.0,
+                 'maxClientKbps': max(rates) * 8 / 1000.0 if rates else 0.0}
+        if self.rateControl is not None:
+            stats.update({'quality': self.rateControl.quality, 'scale': self.rateControl.scale,
+                          'fps': self.rateControl.fps})
+        return stats
+
+    def waitFrame(self, lastSeq, timeout=None):
+        # Wait for a frame newer than lastSeq, returns (seq, jpeg bytes) of the newest frame,
+        # or (lastSeq, None) on timeout / stop
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > lastSeq or self.stopped, timeout)
+            if self.seq <= lastSeq:
+                return lastSeq, None
+            return self.seq, self.jpeg
     
     def read(self):
         return self.frame
@@ -62,12 +201,18 @@ class MJPGHandler:
     def stop(self):
         # Indicate that the camera and thread should be stopped
         self.stopped = True
+        with self.cond:
+            self.cond.notify_all()
+        self.server.shutdown()
         self.server.server_close()
 
 
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     "Threaded Server"
+    # Viewer threads never hold up shutdown, and a restart can rebind the port right away
+    daemon_threads = True
+    allow_reuse_address = True
 
 class CamHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -78,20 +223,26 @@ class CamHandler(BaseHTTPRequestHandler):
                 'multipart/x-mixed-replace; boundary=--jpgboundary'
             )
             self.end_headers()
-            i = 0
-            while True:
+            stream = self.server.stream
+            stream.clientStart(self)
+            # A viewer that can't take a frame within sendTimeout gets dropped
+            self.connection.settimeout(stream.sendTimeout)
+            minInterval = (1.0 / stream.maxFps) if stream.maxFps > 0 else 0.0
+            nextSend = 0.0
+            # Start with whatever frame is current so the viewer sees something right away
+            lastSeq = -1
+            while not stream.stopped:
                 try:
-#                     if i%2==0: test code
-#                         processedFrame = blankFrame
-#                     else:
-#                         processedFrame = blankFrame2
-#                     i+=1
-
-                    rc, img = processedGrabbed, processedFrame
-                    if not rc:
+                    # Stay under this viewer's frame rate cap, frames that come in meanwhile are skipped
+                    wait = nextSend - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+
+                    # Sleep until there is a frame we haven't sent, then send the newest one
+                    lastSeq, img_str = stream.waitFrame(lastSeq, timeout=1.0)
+                    if img_str is None:
                         continue
-                           
-                    img_str = cv2.imencode('.jpg', processedFrame)[1].tostring()
+                    nextSend = time.monotonic() + minInterval
 
                     self.send_header('Content-type', 'image/jpeg')
                     self.send_header('Content-length', len(img_str))
@@ -99,12 +250,16 @@ class CamHandler(BaseHTTPRequestHandler):
 
                     self.wfile.write(img_str)
                     self.wfile.write(b"\r\n--jpgboundary\r\n")
+                    stream.countSent(self, len(img_str))
 
                 except KeyboardInterrupt:
                     self.wfile.write(b"\r\n--jpgboundary--\r\n")
                     break
-                except BrokenPipeError:
-                    continue
+                except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                    # Viewer went away or is too slow, drop it
+                    self.close_connection = True
+                    break
+            stream.clientDone(self)
             return
 
         if self.path.endswith('.html'):
@@ -112,6 +267,6 @@ class CamHandler(BaseHTTPRequestHandler):
             self.send_header('Content-type', 'text/html')
             self.end_headers()
             self.wfile.write(b'<html><head></head><body>')
-            self.wfile.write(b'<img src="http://192.168.1.199:8080/cam.mjpg"/>')
+            self.wfile.write(b'<img src="/cam.mjpg"/>')
             self.wfile.write(b'</body></html>')
             return
\ No newline at end of file
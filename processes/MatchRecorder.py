@@ -0,0 +1,193 @@
+# Non-blocking match recorder
+#
+# write() is called from a pipeline stage and never waits on the disk: the frame is copied into
+# one of a few preallocated buffers and queued, and a writer thread encodes it with
+# cv2.VideoWriter. If every buffer is still waiting to be written (the disk or the encoder fell
+# behind), the frame is dropped instead. The queue is latest-wins, so the oldest waiting frame
+# goes first.
+#
+# A recorder made with a source (VideoStream) takes every camera frame itself while recording,
+# from a thread waiting on the stream like TargetTracker does, so the raw video has every frame
+# the camera captured no matter what the pipeline dropped. Others get frames from write(), e.g.
+# from a pipeline stage running at the inference rate. Frames written with their capture
+# timestamp are placed in the file by that time: a frame repeats until the next one is due, so a
+# file written at 8 fps of inference still plays back in real time at fps.
+#
+# Files rotate after maxSeconds or maxBytes, and whenever the frame size changes (the
+# annotated stream frames shrink when the stream rate control scales them down).
+# start() / stop() begin and end a recording, e.g. from an NT entry the robot sets while enabled.
+
+import os
+import time
+from threading import Thread, Lock
+import numpy as np
+import cv2
+from processes.Pipeline import LatestQueue
+
+
+class MatchRecorder:
+    """Records frames to rotating video files from its own thread, dropping frames rather than blocking"""
+    def __init__(self, outDir, name='raw', fps=30, maxSeconds=150, maxBytes=500*1024*1024, buffers=8, fourcc='MJPG',
+                 source=None):
+        self.outDir = outDir
+        self.source = source
+        self.name = name
+        self.fps = fps
+        self.maxSeconds = maxSeconds
+        self.maxBytes = maxBytes
+        self.nBuffers = buffers
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+
+        # Copy buffers, allocated for the first frame's shape
+        self.lock = Lock()
+        self.free = []
+        self.shape = None
+
+        self.recording = False
+        self.queue = None
+        self.thread = None
+        self.tapThread = None
+
+        # Current file
+        self.writer = None
+        self.path = None
+        self.fileShape = None
+        self.fileStart = 0.0
+        self.fileTime = None
+        self.fileFrames = 0
+        self.nextSizeCheck = 0
+
+        # Counters
+        self.frames = 0
+        self.dropped = 0
+        self.files = 0
+
+    def start(self):
+        if self.recording:
+            return
+        os.makedirs(self.outDir, exist_ok=True)
+        with self.lock:
+            # Fresh buffers, in case a frame was queued after the last stop()
+            self.shape = None
+        self.queue = LatestQueue(self.nBuffers, onDrop=self.dropQueued)
+        self.recording = True
+        self.thread = Thread(target=self.run, args=(self.queue,), name='recorder-' + self.name, daemon=True)
+        self.thread.start()
+        if self.source is not None:
+            self.tapThread = Thread(target=self.tap, args=(self.source,), name='recorder-tap-' + self.name, daemon=True)
+            self.tapThread.start()
+        print("recorder %s: started" % self.name)
+
+    def stop(self):
+        # Frames already queued still get written
+        if not self.recording:
+            return
+        self.recording = False
+        if self.tapThread is not None:
+            # Stops within one readNew timeout
+            self.tapThread.join(1.0)
+            self.tapThread = None
+        self.queue.close()
+        self.thread.join(5.0)
+        print("recorder %s: stopped, %d frames, %d dropped" % (self.name, self.frames, self.dropped))
+
+    def write(self, frame, t=None):
+        # Queue a copy of frame captured at time t (time.monotonic(), None to write it just once),
+        # returns False if it was dropped (or we aren't recording)
+        if not self.recording:
+            return False
+        with self.lock:
+            if self.shape != frame.shape:
+                # First frame, or the size changed: new set of buffers
+                self.shape = frame.shape
+                self.free = [np.empty(frame.shape, frame.dtype) for n in range(self.nBuffers)]
+            if not self.free:
+                self.dropped += 1
+                return False
+            buffer = self.free.pop()
+        np.copyto(buffer, frame)
+        self.queue.put((buffer, t))
+        return True
+
+    def tap(self, source):
+        # Write every new frame of source while recording, holding it only for the copy
+        seq = 0
+        while self.recording:
+            newFrame = source.readNew(seq, timeout=0.5, hold=True)
+            if newFrame is None:
+                continue
+            seq, stamp, frame = newFrame
+            try:
+                self.write(frame, stamp)
+            finally:
+                source.release(seq)
+
+    def giveBack(self, buffer):
+        with self.lock:
+            # Buffers from before a size change are just let go
+            if buffer.shape == self.shape:
+                self.free.append(buffer)
+
+    def dropQueued(self, item):
+        self.dropped += 1
+        self.giveBack(item[0])
+
+    def run(self, queue):
+        while True:
+            item = queue.get(timeout=0.5)
+            if item is None:
+                if queue.closed:
+                    break
+                continue
+            buffer, t = item
+            try:
+                self.writeFrame(buffer, t)
+            finally:
+                self.giveBack(buffer)
+        self.closeFile()
+
+    def writeFrame(self, frame, t=None):
+        now = time.monotonic()
+        if self.writer is None or self.needsRotate(frame, now):
+            self.closeFile()
+            self.openFile(frame, now)
+        repeat = 1
+        if t is not None:
+            if self.fileTime is None:
+                self.fileTime = t
+            # Frame slots up to and including the one t falls in, an early frame is skipped
+            repeat = int((t - self.fileTime) * self.fps) + 1 - self.fileFrames
+        for n in range(repeat):
+            self.writer.write(frame)
+        self.fileFrames += max(0, repeat)
+        self.frames += 1
+
+    def needsRotate(self, frame, now):
+        if frame.shape != self.fileShape or now - self.fileStart >= self.maxSeconds:
+            return True
+        # Checking the size once a second of video is plenty
+        if self.fileFrames >= self.nextSizeCheck:
+            self.nextSizeCheck = self.fileFrames + max(1, int(self.fps))
+            try:
+                return os.path.getsize(self.path) >= self.maxBytes
+            except OSError:
+                return False
+        return False
+
+    def openFile(self, frame, now):
+        self.path = os.path.join(self.outDir, '%s-%s-%d.avi' % (self.name, time.strftime('%Y%m%d-%H%M%S'), self.files))
+        self.writer = cv2.VideoWriter(self.path, self.fourcc, self.fps, (frame.shape[1], frame.shape[0]))
+        self.fileShape = frame.shape
+        self.fileStart = now
+        self.fileTime = None
+        self.fileFrames = 0
+        self.nextSizeCheck = max(1, int(self.fps))
+        self.files += 1
+
+    def closeFile(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+    def stats(self):
+        return {'recording': self.recording, 'frames': self.frames, 'dropped': self.dropped, 'files': self.files}
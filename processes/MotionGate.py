@@ -0,0 +1,86 @@
+# Motion gate: skip inference when the scene hasn't changed
+#
+# While the robot is parked and nothing moves in front of it, every invoke() finds the same
+# targets again for the cost of a full inference. check() shrinks the frame to a small
+# grayscale image (into preallocated buffers) and counts the pixels that differ by more than
+# pixelDelta from the last frame that was inferred. If fewer than a `changed` fraction of
+# them did, the frame reuses that frame's detections instead of running the model.
+# Comparing against the last inferred frame rather than the previous frame means slow drift
+# still adds up to a change. Detections are never reused for longer than maxAge seconds.
+# A frame check() lets reuse can still be dropped by the caller (the results it would reuse
+# aren't in yet), drop() counts it as dropped instead of reused.
+
+import numpy as np
+import cv2
+
+
+class MotionGate:
+    """Decides per frame whether it needs inference or can reuse the last results"""
+    def __init__(self, width=64, height=48, pixelDelta=12, changed=0.003, maxAge=1.0):
+        self.size = (width, height)
+        self.pixelDelta = pixelDelta
+        self.changed = changed
+        self.maxAge = maxAge
+
+        self.small = np.empty((height, width, 3), np.uint8)
+        self.gray = np.empty((height, width), np.uint8)
+        self.reference = np.empty((height, width), np.uint8)
+        self.diff = np.empty((height, width), np.uint8)
+        self.hasReference = False
+        self.refTime = 0.0
+
+        # Counters, plus the ones since the last stats() for the skip ratio
+        self.inferred = 0
+        self.reused = 0
+        self.dropped = 0
+        self.windowInferred = 0
+        self.windowReused = 0
+        self.windowDropped = 0
+        self.reuseAge = 0.0
+        self.changedFraction = 0.0
+
+    def check(self, frame, t):
+        # True if the frame captured at time t needs inference, False to reuse the last results
+        cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        if self.hasReference and t - self.refTime <= self.maxAge:
+            cv2.absdiff(self.gray, self.reference, dst=self.diff)
+            cv2.threshold(self.diff, self.pixelDelta, 255, cv2.THRESH_BINARY, dst=self.diff)
+            self.changedFraction = cv2.countNonZero(self.diff) / float(self.diff.size)
+            if self.changedFraction < self.changed:
+                self.reused += 1
+                self.windowReused += 1
+                self.reuseAge = t - self.refTime
+                return False
+
+        # This frame gets inferred and becomes the new reference
+        self.gray, self.reference = self.reference, self.gray
+        self.hasReference = True
+        self.refTime = t
+        self.inferred += 1
+        self.windowInferred += 1
+        self.reuseAge = 0.0
+        return True
+
+    def drop(self):
+        # The frame check() just let reuse the last results was dropped instead
+        self.reused -= 1
+        self.windowReused -= 1
+        self.dropped += 1
+        self.windowDropped += 1
+
+    def reset(self):
+        # The frame check() just passed never got inferred, make the next one run
+        self.hasReference = False
+
+    def stats(self, reset=True):
+        # skipRatio is the share of frames reused since the last call, dropped ones count as not reused
+        window = self.windowInferred + self.windowReused + self.windowDropped
+        stats = {'skipRatio': self.windowReused / float(window) if window else 0.0,
+                 'reuseAgeMs': self.reuseAge * 1000.0, 'changed': self.changedFraction,
+                 'inferred': self.inferred, 'reused': self.reused, 'dropped': self.dropped}
+        if reset:
+            self.windowInferred = 0
+            self.windowReused = 0
+            self.windowDropped = 0
+        return stats
@@ -0,0 +1,86 @@
+# Change-driven, batched NetworkTables publisher
+#
+# Looks up every table / entry handle once and caches it, instead of walking
+# getSubTable(...).getSubTable(...) for each put. A value is only written when it changed
+# by more than a tolerance, and everything written during a frame goes out together with a
+# single NetworkTables.flush(). Less CPU per frame and less traffic on the robot radio.
+
+from threading import Lock
+from networktables import NetworkTables
+
+# Rough size of an NT3 entry update on the wire without the value itself
+# (message type, entry id, sequence number, value type)
+UPDATE_OVERHEAD = 6
+
+
+class NTPublisher:
+    """Publishes values under a root table through cached entries, only when they change"""
+    def __init__(self, table, tolerance=1e-3):
+        self.table = table
+        self.tolerance = tolerance
+        # path -> [entry, last value written]
+        self.entries = {}
+        self.dirty = False
+        self.lock = Lock()
+
+        # Counters
+        self.puts = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.flushes = 0
+
+    def getEntry(self, path):
+        # Entry for a '/' separated path below the root table, e.g. 'targets/mainTgt/tX'
+        slot = self.entries.get(path)
+        if slot is None:
+            table = self.table
+            names = path.split('/')
+            for name in names[:-1]:
+                table = table.getSubTable(name)
+            slot = [table.getEntry(names[-1]), None]
+            self.entries[path] = slot
+        return slot
+
+    def put(self, path, value, tolerance=None):
+        # Write value if it differs from the last one written by more than tolerance.
+        # Returns True if it was written
+        with self.lock:
+            slot = self.getEntry(path)
+            last = slot[1]
+            if last is not None and self.unchanged(last, value, self.tolerance if tolerance is None else tolerance):
+                self.skipped += 1
+                return False
+
+            entry = slot[0]
+            if isinstance(value, bool):
+                entry.setBoolean(value)
+                size = 1
+            elif isinstance(value, str):
+                entry.setString(value)
+                size = len(value.encode()) + 2
+            else:
+                value = float(value)
+                entry.setDouble(value)
+                size = 8
+            slot[1] = value
+            self.puts += 1
+            self.bytes += UPDATE_OVERHEAD + size
+            self.dirty = True
+            return True
+
+    def unchanged(self, last, value, tolerance):
+        if isinstance(value, (bool, str)) or isinstance(last, (bool, str)):
+            return last == value
+        return abs(float(value) - last) <= tolerance
+
+    def flush(self):
+        # Send everything written since the last flush right away, once per frame
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.flushes += 1
+        NetworkTables.flush()
+
+    def stats(self):
+        return {'puts': self.puts, 'skipped': self.skipped, 'bytes': self.bytes, 'flushes': self.flushes}
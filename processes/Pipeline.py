@@ -0,0 +1,247 @@
+# Multi-stage threaded pipeline (capture -> preprocess -> infer -> postprocess -> publish)
+#
+# Every stage runs in its own worker thread and the stages are joined by small bounded
+# "latest wins" queues. If a stage falls behind, the oldest item waiting for it is dropped
+# instead of blocking the stage before it. That way the stages overlap, the pipeline always
+# works on the freshest frame and throughput approaches the slowest stage instead of the
+# sum of all of them.
+
+from threading import Thread, Condition, Lock
+from collections import deque
+import time
+import traceback
+
+
+class LatestQueue:
+    """Bounded queue that drops its oldest item instead of blocking when it is full"""
+    def __init__(self, maxsize=1, onDrop=None):
+        self.items = deque()
+        self.maxsize = maxsize
+        self.onDrop = onDrop
+        self.dropped = 0
+        self.closed = False
+        self.cond = Condition()
+
+    def put(self, item):
+        old = None
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                old = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+        # Hand the dropped item back outside the lock (e.g. to release its camera buffer)
+        if old is not None and self.onDrop is not None:
+            self.onDrop(old)
+
+    def get(self, timeout=None):
+        # Return the next item, or None on timeout / once the queue is closed and empty
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.closed, timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def depth(self):
+        return len(self.items)
+
+    def drain(self):
+        # Remove and return everything still waiting in the queue
+        with self.cond:
+            items = list(self.items)
+            self.items.clear()
+        return items
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Stage:
+    """One pipeline step running fn in its own worker thread(s)"""
+    def __init__(self, name, fn, inQueue=None, outQueue=None, pipeline=None, workers=1, ordered=False):
+        self.name = name
+        self.fn = fn
+        self.inQueue = inQueue
+        self.outQueue = outQueue
+        self.pipeline = pipeline
+        self.workers = workers
+        self.threads = []
+
+        # Ordered stages only let through items newer than the last one they passed on
+        self.ordered = ordered
+        self.lastSeq = 0
+        self.stale = 0
+        self.lock = Lock()
+
+        # Timing stats, all in seconds
+        self.count = 0
+        self.errors = 0
+        self.rejected = 0
+        self.totalTime = 0.0
+        self.lastTime = 0.0
+        self.maxTime = 0.0
+        self.emaTime = 0.0
+        self.emaInterval = 0.0
+        self.lastDone = None
+
+    def start(self):
+        self.threads = []
+        for n in range(self.workers):
+            thread = Thread(target=self.run, args=(), name='%s-%d' % (self.name, n), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def isStale(self, item):
+        # With several upstream workers results can arrive out of order, an item older
+        # than one we already passed on is stale and gets dropped
+        seq = item[self.pipeline.seqKey]
+        lateKey = self.pipeline.lateKey
+        with self.lock:
+            if seq <= self.lastSeq:
+                if lateKey is not None and item.get(lateKey):
+                    # Worth having even late, passed on without moving lastSeq back
+                    return False
+                self.stale += 1
+                return True
+            self.lastSeq = seq
+            return False
+
+    def run(self):
+        pipeline = self.pipeline
+        while not pipeline.stopped:
+            # A stage without an input queue is the source, fn() produces the next item
+            if self.inQueue is None:
+                item = None
+            else:
+                item = self.inQueue.get(timeout=0.1)
+                if item is None:
+                    continue
+                if self.ordered and self.isStale(item):
+                    pipeline.release(item)
+                    continue
+
+            t0 = time.perf_counter()
+            failed = False
+            try:
+                result = self.fn() if self.inQueue is None else self.fn(item)
+            except Exception:
+                traceback.print_exc()
+                self.errors += 1
+                failed = True
+                result = None
+            t1 = time.perf_counter()
+            self.record(t1 - t0, t1)
+
+            # None means the stage dropped the item (counted apart from the ones it failed on)
+            if result is None:
+                if item is not None:
+                    if not failed:
+                        with self.lock:
+                            self.rejected += 1
+                    pipeline.release(item)
+                continue
+            if self.outQueue is not None:
+                self.outQueue.put(result)
+            else:
+                pipeline.release(result)
+
+    def record(self, elapsed, now, alpha=0.1):
+        with self.lock:
+            self._record(elapsed, now, alpha)
+        if self.pipeline.timing is not None:
+            self.pipeline.timing.record(self.name, elapsed * 1000.0)
+
+    def _record(self, elapsed, now, alpha):
+        self.count += 1
+        self.totalTime += elapsed
+        self.lastTime = elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+        self.emaTime = elapsed if self.count == 1 else (1 - alpha) * self.emaTime + alpha * elapsed
+        if self.lastDone is not None:
+            interval = now - self.lastDone
+            self.emaInterval = interval if self.emaInterval == 0 else (1 - alpha) * self.emaInterval + alpha * interval
+        self.lastDone = now
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'lastMs': self.lastTime * 1000.0,
+            'avgMs': (self.totalTime / self.count * 1000.0) if self.count else 0.0,
+            'emaMs': self.emaTime * 1000.0,
+            'maxMs': self.maxTime * 1000.0,
+            'fps': (1.0 / self.emaInterval) if self.emaInterval > 0 else 0.0,
+            'queueDepth': self.inQueue.depth() if self.inQueue is not None else 0,
+            'dropped': self.inQueue.dropped if self.inQueue is not None else 0,
+            'stale': self.stale,
+            'rejected': self.rejected,
+        }
+
+
+class Pipeline:
+    """Chain of stages joined by latest-wins queues.
+
+    The first stage added with addSource() produces items, every stage added with
+    addStage() takes the previous stage's item and returns the item to pass on (or None
+    to drop it). onRelease(item) is called exactly once for every item that leaves the
+    pipeline, whether it finished the last stage or was dropped on the way.
+
+    stats() counts per stage the items dropped from its input queue, the ones an ordered stage
+    found stale, the ones fn dropped (rejected) and the ones fn raised on (errors).
+
+    A stage can run several workers (e.g. one per interpreter in an InterpreterPool).
+    Put an ordered stage after it to drop results that come back older than item[seqKey]
+    of one already passed on. Items with item[lateKey] set are passed on even when late.
+
+    With a timing (LatencyHistogram.Timing) every stage call also goes into a histogram
+    named after the stage.
+    """
+    def __init__(self, queueSize=1, onRelease=None, seqKey='seq', timing=None, lateKey=None):
+        self.queueSize = queueSize
+        self.onRelease = onRelease
+        self.seqKey = seqKey
+        self.lateKey = lateKey
+        self.timing = timing
+        self.stages = []
+        self.stopped = True
+
+    def addSource(self, name, fn):
+        self.stages.append(Stage(name, fn, pipeline=self))
+        return self
+
+    def addStage(self, name, fn, workers=1, ordered=False):
+        queue = LatestQueue(self.queueSize, onDrop=self.release)
+        self.stages[-1].outQueue = queue
+        self.stages.append(Stage(name, fn, inQueue=queue, pipeline=self, workers=workers, ordered=ordered))
+        return self
+
+    def release(self, item):
+        if self.onRelease is not None:
+            self.onRelease(item)
+
+    def start(self):
+        self.stopped = False
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        for stage in self.stages:
+            if stage.inQueue is not None:
+                stage.inQueue.close()
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.join(1.0)
+        # Anything still queued never reached the end, hand it back
+        for stage in self.stages:
+            if stage.inQueue is not None:
+                for item in stage.inQueue.drain():
+                    self.release(item)
+
+    def stats(self):
+        # Per-stage timings plus the depth of the queue feeding each stage
+        return {stage.name: stage.stats() for stage in self.stages}
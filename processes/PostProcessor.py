@@ -0,0 +1,130 @@
+# Vectorized detection post-processing
+#
+# Instead of looping over every detection in Python (threshold check, box scaling with
+# max()/min(), label lookup, target type compare), the whole boxes/classes/scores tensors
+# are processed at once with NumPy. The math always runs on the model's full, fixed number
+# of detections into preallocated buffers, so the work per frame is the same however many
+# objects the model finds. The kept detections come out as column arrays.
+
+import numpy as np
+
+# Camera field of view in degrees, shared by the live scripts and the replay benchmark
+X_FOV = 60
+Y_FOV = 34
+
+
+class Detections:
+    """Column arrays for the detections of one frame, only the first count rows are valid"""
+    columns = (
+        ('xmin', np.int32), ('ymin', np.int32), ('xmax', np.int32), ('ymax', np.int32),
+        ('xCenter', np.float32), ('yCenter', np.float32), ('area', np.int32),
+        ('score', np.float32), ('conf', np.int32), ('tX', np.float32), ('tY', np.float32),
+        ('classId', np.int32), ('isTarget', np.bool_), ('tgtNum', np.int32),
+    )
+
+    def __init__(self, size):
+        self.count = 0
+        self.targetCount = 0
+        for name, dtype in self.columns:
+            setattr(self, name, np.zeros(size, dtype=dtype))
+
+
+class PostProcessor:
+    """Turns raw model output into Detections in frame pixel coordinates.
+
+    Detections come from a small ring, the one returned stays valid for the next
+    ringSize - 1 calls, so keep ringSize above the number of frames in flight after this.
+    """
+    def __init__(self, imW, imH, minConf=0.5, xFov=X_FOV, yFov=Y_FOV, ringSize=4):
+        self.imW = imW
+        self.imH = imH
+        self.minConf = minConf
+
+        # Precomputed box scale and clip vectors for [ymin, xmin, ymax, xmax].
+        # Interpreter can return coordinates that are outside of image dimensions,
+        # mins are clipped to at least 1 and maxes to at most the image size
+        self.scale = np.array([imH, imW, imH, imW], dtype=np.float32)
+        self.lo = np.array([1, 1, -np.inf, -np.inf], dtype=np.float32)
+        self.hi = np.array([np.inf, np.inf, imH, imW], dtype=np.float32)
+
+        # Degrees per pixel from the image center
+        self.xDegPerPx = (xFov / 2.0) / (imW / 2.0)
+        self.yDegPerPx = (yFov / 2.0) / (imH / 2.0)
+
+        self.ringSize = ringSize
+        self.size = 0
+        self.next = 0
+
+    def allocate(self, size):
+        # Buffers sized to the model's number of detections, made on the first frame
+        self.size = size
+        self.keep = np.zeros(size, dtype=np.bool_)
+        self.inRange = np.zeros(size, dtype=np.bool_)
+        self.px = np.zeros((size, 4), dtype=np.float32)
+        self.boxH = np.zeros(size, dtype=np.int32)
+        self.percent = np.zeros(size, dtype=np.float32)
+        self.all = Detections(size)
+        self.ring = [Detections(size) for n in range(self.ringSize)]
+
+    def process(self, boxes, classes, scores, targetClassId=-1):
+        n = len(scores)
+        if n != self.size:
+            self.allocate(n)
+        a = self.all
+
+        # Threshold mask
+        np.greater(scores, self.minConf, out=self.keep)
+        np.less_equal(scores, 1.0, out=self.inRange)
+        np.logical_and(self.keep, self.inRange, out=self.keep)
+
+        # Scale normalized boxes to pixels, clip, and truncate to int like int() did
+        np.multiply(boxes, self.scale, out=self.px)
+        np.clip(self.px, self.lo, self.hi, out=self.px)
+        np.copyto(a.ymin, self.px[:, 0], casting='unsafe')
+        np.copyto(a.xmin, self.px[:, 1], casting='unsafe')
+        np.copyto(a.ymax, self.px[:, 2], casting='unsafe')
+        np.copyto(a.xmax, self.px[:, 3], casting='unsafe')
+
+        # Centers: min + (max - min) / 2
+        np.subtract(a.xmax, a.xmin, out=a.xCenter, casting='unsafe')
+        np.multiply(a.xCenter, 0.5, out=a.xCenter)
+        np.add(a.xCenter, a.xmin, out=a.xCenter, casting='unsafe')
+        np.subtract(a.ymax, a.ymin, out=a.yCenter, casting='unsafe')
+        np.multiply(a.yCenter, 0.5, out=a.yCenter)
+        np.add(a.yCenter, a.ymin, out=a.yCenter, casting='unsafe')
+
+        # Area in pixels
+        np.subtract(a.xmax, a.xmin, out=a.area)
+        np.subtract(a.ymax, a.ymin, out=self.boxH)
+        np.multiply(a.area, self.boxH, out=a.area)
+
+        # Confidence in whole percent
+        np.copyto(a.score, scores, casting='unsafe')
+        np.multiply(a.score, 100.0, out=self.percent)
+        np.copyto(a.conf, self.percent, casting='unsafe')
+
+        # Angles to the target from the image center
+        np.subtract(a.xCenter, self.imW / 2.0, out=a.tX)
+        np.multiply(a.tX, self.xDegPerPx, out=a.tX)
+        np.subtract(a.yCenter, self.imH / 2.0, out=a.tY)
+        np.multiply(a.tY, self.yDegPerPx, out=a.tY)
+
+        # Class ids and which detections are the target type
+        np.copyto(a.classId, classes, casting='unsafe')
+        np.equal(a.classId, targetClassId, out=a.isTarget)
+
+        # Pack the kept rows into the next Detections in the ring
+        d = self.ring[self.next]
+        self.next = (self.next + 1) % self.ringSize
+        count = int(np.count_nonzero(self.keep))
+        for name, dtype in Detections.columns:
+            if name == 'tgtNum':
+                continue
+            np.compress(self.keep, getattr(a, name), out=getattr(d, name)[:count])
+        d.count = count
+
+        # Number each target in detection order, non-targets get the number of the next one
+        np.cumsum(d.isTarget[:count], out=d.tgtNum[:count])
+        np.subtract(d.tgtNum[:count], d.isTarget[:count], out=d.tgtNum[:count])
+        d.targetCount = int(np.count_nonzero(d.isTarget[:count]))
+        return d
@@ -0,0 +1,69 @@
+# Preprocessing that writes camera frames straight into an interpreter's input tensor
+#
+# The frame is resized first and color converted second, so cvtColor only touches the
+# model sized image (300x300) instead of the full 1280x720 capture. Both steps write into
+# preallocated buffers with dst=, the last one directly into the memory returned by
+# interpreter.tensor(), so nothing is allocated per frame and set_tensor() is not needed.
+#
+# Models that don't take raw uint8 pixels (float EfficientDet variants, int8 models) get their
+# normalization from a 256 entry lookup table built once at startup, instead of doing
+# (float(x) - mean) / std with two temporary float arrays every frame.
+
+import cv2
+import numpy as np
+
+
+def buildInputTable(inputDetails, inputMean=127.5, inputStd=127.5):
+    # Lookup table mapping every uint8 pixel value to what the model input expects, or None
+    # if the model takes raw uint8 pixels
+    dtype = inputDetails['dtype']
+    if dtype == np.uint8:
+        return None
+    table = (np.arange(256, dtype=np.float64) - inputMean) / inputStd
+    if dtype == np.float32:
+        return table.astype(np.float32)
+    if dtype == np.int8:
+        # Quantized input, map the normalized value through the tensor's scale / zero point
+        scale, zeroPoint = inputDetails['quantization']
+        if scale == 0:
+            scale, zeroPoint = 1.0 / 128, 0
+        return np.clip(np.round(table / scale + zeroPoint), -128, 127).astype(np.int8)
+    raise ValueError('unsupported model input type %s' % dtype)
+
+
+class Preprocessor:
+    """Resizes and color converts frames into the model input. Use one per thread."""
+    def __init__(self, inputDetails, inputMean=127.5, inputStd=127.5):
+        self.index = inputDetails['index']
+        self.height = int(inputDetails['shape'][1])
+        self.width = int(inputDetails['shape'][2])
+        self.table = buildInputTable(inputDetails, inputMean, inputStd)
+
+        # Scratch buffers at model resolution
+        self.resized = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.rgb = np.empty((self.height, self.width, 3), dtype=np.uint8)
+
+        # interpreter.tensor() accessor for every interpreter we have written to
+        self.accessors = {}
+
+    def inputTensor(self, interpreter):
+        accessor = self.accessors.get(id(interpreter))
+        if accessor is None:
+            accessor = interpreter.tensor(self.index)
+            self.accessors[id(interpreter)] = accessor
+        return accessor
+
+    def into(self, frame, interpreter):
+        # Fill the interpreter's input tensor from a BGR frame of any size.
+        # Only the accessor is kept, the numpy view must be gone before invoke() runs
+        view = self.inputTensor(interpreter)()[0]
+        cv2.resize(frame, (self.width, self.height), dst=self.resized)
+        if self.table is None:
+            cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=view)
+        else:
+            # Normalize pixel values through the lookup table (i.e. if model is non-quantized).
+            # cv2.LUT does the same as np.take(table, rgb, out=view) but without np.take's
+            # temporary intp copy of the index array
+            cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.rgb)
+            cv2.LUT(self.rgb, self.table, dst=view)
+        del view
@@ -0,0 +1,127 @@
+# On-demand sampling profiler, started over NetworkTables
+#
+# Put a number of seconds in status/profile (e.g. from the dashboard while FPS is down on the
+# field) and a background thread samples the Python stack of every thread of the running
+# program that often per second for that long. cProfile would only see the thread it was
+# started in, while the pipeline runs every stage in its own thread.
+#
+# When the session is over it writes two files to outDir and puts the path of the first one in
+# status/profilePath:
+#   profile-<time>.pstats         load with pstats.Stats(path). Times are samples x interval;
+#                                 call counts are sample counts, not real calls
+#   profile-<time>.collapsed.txt  "thread;outer;...;inner count" lines for flamegraph tools
+#
+# Nothing runs while no session is active, the only cost is the NT entry listener.
+
+import os
+import sys
+import time
+import marshal
+import threading
+from collections import Counter
+
+
+class Profiler:
+    """Samples every thread's stack for N seconds when status/profile is set"""
+    def __init__(self, table, outDir='profiles', rate=200, maxSeconds=60, key='profile'):
+        # table is the NT table holding the profile / profilePath entries.
+        # rate is samples per second, maxSeconds bounds any one session
+        self.table = table
+        self.outDir = outDir
+        self.interval = 1.0 / rate
+        self.maxSeconds = maxSeconds
+        self.key = key
+        self.thread = None
+        self.lastPath = ''
+
+        table.putNumber(key, 0)
+        table.addEntryListener(self.profileChanged, immediateNotify=False, key=key, localNotify=True)
+
+    def profileChanged(self, source, key, value, isNew):
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            return
+        if seconds > 0:
+            self.start(seconds)
+
+    def start(self, seconds):
+        # Returns False if a session is already running
+        if self.thread is not None and self.thread.is_alive():
+            return False
+        seconds = min(seconds, self.maxSeconds)
+        self.thread = threading.Thread(target=self.run, args=(seconds,), name='profiler', daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self, seconds):
+        print("profiler: sampling for %.0f s" % seconds)
+        stacks, elapsed, samples = self.sample(seconds)
+        path = self.write(stacks, elapsed / max(samples, 1))
+        self.lastPath = path
+        print("profiler: %d samples written to %s" % (samples, path))
+        # Report where it went and clear the request so the same value can start another session
+        self.table.putString(self.key + 'Path', path)
+        self.table.putNumber(self.key, 0)
+
+    def sample(self, seconds):
+        # Counter of (thread name, stack of code objects outermost first) -> samples
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        start = time.monotonic()
+        end = start + seconds
+        while time.monotonic() < end:
+            names = None
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                if names is None:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, time.monotonic() - start, samples
+
+    def write(self, stacks, interval):
+        os.makedirs(self.outDir, exist_ok=True)
+        base = os.path.join(self.outDir, time.strftime('profile-%Y%m%d-%H%M%S'))
+
+        with open(base + '.collapsed.txt', 'w') as f:
+            for (threadName, stack), count in stacks.most_common():
+                f.write(';'.join([threadName] + [self.label(code) for code in stack]) + ' %d\n' % count)
+
+        with open(base + '.pstats', 'wb') as f:
+            marshal.dump(self.toPstats(stacks, interval), f)
+        return base + '.pstats'
+
+    def label(self, code):
+        return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def toPstats(self, stacks, interval):
+        # The dict pstats.Stats loads: (file, line, name) -> (calls, primitive calls, own time,
+        # cumulative time, {caller: calls}). A function's samples count as its calls
+        selfCount = Counter()
+        totalCount = Counter()
+        callers = {}
+        for (threadName, stack), count in stacks.items():
+            keys = [(code.co_filename, code.co_firstlineno, code.co_name) for code in stack]
+            if not keys:
+                continue
+            selfCount[keys[-1]] += count
+            # Recursive functions only count once per sample
+            for key in set(keys):
+                totalCount[key] += count
+            for caller, callee in zip(keys, keys[1:]):
+                calls = callers.setdefault(callee, Counter())
+                calls[caller] += count
+
+        stats = {}
+        for key, total in totalCount.items():
+            stats[key] = (total, total, selfCount[key] * interval, total * interval, dict(callers.get(key, {})))
+        return stats
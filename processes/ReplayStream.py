@@ -0,0 +1,138 @@
+# Recorded video as a frame source, for running the pipeline without a camera
+#
+# Same readNew() / release() / stop() interface as VideoStream, fed from a video file or a
+# directory of images (sorted by name) instead of a webcam.
+# With fps=0 every call to readNew() returns the next frame right away, so the pipeline runs as
+# fast as it can and sees every frame. With an fps the frames are paced like a camera: readNew()
+# waits for the next frame's time, and frames the reader was too slow for are skipped.
+import os
+import time
+from threading import Lock
+import cv2
+
+IMAGE_TYPES = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class ReplayStream:
+    """Frames from a video file or an image directory, paced or as fast as they are read"""
+    def __init__(self, path, fps=0, loop=False, preload=False, maxFrames=0):
+        # preload decodes every frame up front so decoding isn't part of what gets measured.
+        # maxFrames stops after that many frames (0 = the whole recording)
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        self.maxFrames = maxFrames
+        self.lock = Lock()
+
+        if os.path.isdir(path):
+            self.files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith(IMAGE_TYPES))
+            self.stream = None
+        else:
+            self.files = None
+            self.stream = cv2.VideoCapture(path)
+            if not self.stream.isOpened():
+                raise IOError("can't open video " + path)
+
+        # Index of the next frame in the recording, sequence number of the last frame handed out
+        self.position = 0
+        self.seq = 0
+        self.skipped = 0
+        self.stopped = False
+
+        self.frames = None
+        if preload:
+            self.frames = []
+            frame = self.decode()
+            while frame is not None and (maxFrames <= 0 or len(self.frames) < maxFrames):
+                self.frames.append(frame)
+                frame = self.decode()
+            self.position = 0
+
+        # First frame tells the resolution
+        first = self.frames[0] if self.frames else self.peek()
+        if first is None:
+            raise IOError("no frames in " + path)
+        self.resolution = (first.shape[1], first.shape[0])
+        self.startTime = None
+
+    def decode(self):
+        # Next frame of the recording, None at the end
+        if self.files is not None:
+            if self.position >= len(self.files):
+                return None
+            frame = cv2.imread(self.files[self.position])
+        else:
+            grabbed, frame = self.stream.read()
+            if not grabbed:
+                return None
+        self.position += 1
+        return frame
+
+    def peek(self):
+        # First frame without using it up
+        frame = self.decode()
+        self.rewind()
+        return frame
+
+    def rewind(self):
+        self.position = 0
+        if self.stream is not None:
+            self.stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def next(self):
+        # Next frame, wrapping around at the end if looping
+        if self.maxFrames > 0 and self.seq >= self.maxFrames and not self.loop:
+            return None
+        if self.frames is not None:
+            if self.position >= len(self.frames):
+                if not self.loop:
+                    return None
+                self.position = 0
+            frame = self.frames[self.position]
+            self.position += 1
+            return frame
+        frame = self.decode()
+        if frame is None and self.loop:
+            self.rewind()
+            frame = self.decode()
+        return frame
+
+    def start(self):
+        self.startTime = time.monotonic()
+        return self
+
+    def readNew(self, lastSeq=0, timeout=None, hold=False):
+        # Return (seq, timestamp, frame) for the next frame, None at the end of the recording.
+        # Every frame is its own array, so hold / release have nothing to protect
+        with self.lock:
+            if self.stopped:
+                return None
+            if self.startTime is None:
+                self.startTime = time.monotonic()
+            if self.fps > 0:
+                # Wait for this frame's time, skip the ones that already went by
+                due = self.startTime + self.seq / self.fps
+                now = time.monotonic()
+                if due > now:
+                    time.sleep(due - now)
+                else:
+                    behind = int((now - due) * self.fps)
+                    for n in range(behind):
+                        if self.next() is None:
+                            return None
+                        self.seq += 1
+                        self.skipped += 1
+            frame = self.next()
+            if frame is None:
+                return None
+            self.seq += 1
+            return (self.seq, time.monotonic(), frame)
+
+    def release(self, seq):
+        pass
+
+    def stop(self):
+        self.stopped = True
+        if self.stream is not None:
+            self.stream.release()
@@ -0,0 +1,113 @@
+# Region-of-interest selection around the locked target
+#
+# A full frame squeezed into a 300x300 model input leaves a distant robot only a few model
+# pixels. Once there is a main target, the next frames are instead cropped around its last box
+# plus a margin for how far it can move before that frame runs, made to the model's aspect
+# ratio, and only that crop is resized into the model input: more detail for the same invoke.
+# Boxes found in the crop are mapped back to full frame coordinates by mapBoxes().
+#
+# Every fullEvery frames, and as soon as the target is lost, the whole frame runs again so
+# targets outside the crop are still found.
+
+from threading import Lock
+
+
+class RoiSelector:
+    """Picks the crop each frame is run on, None meaning the full frame"""
+    def __init__(self, imW, imH, inputW, inputH, margin=0.5, fullEvery=10, minScale=1.0, maxCover=0.6):
+        # margin is extra room on every side as a fraction of the box size, plus however far
+        # the target moves (at its last speed) between its last frame and this one.
+        # Crops are never smaller than the model input times minScale, and a crop covering more
+        # than maxCover of the frame isn't worth it, the full frame runs instead
+        self.imW = imW
+        self.imH = imH
+        self.aspect = float(inputW) / inputH
+        self.minW = inputW * minScale
+        self.minH = inputH * minScale
+        self.margin = margin
+        self.fullEvery = fullEvery
+        self.maxCover = maxCover
+        self.lock = Lock()
+
+        # Last main target box (xmin, ymin, xmax, ymax), the frame it came from, its speed in px per frame
+        self.box = None
+        self.boxSeq = 0
+        self.vx = 0.0
+        self.vy = 0.0
+        self.sinceFull = 0
+
+        # Counters
+        self.roiFrames = 0
+        self.fullFrames = 0
+        self.current = None
+
+    def update(self, seq, box):
+        # Main target box of frame seq in full frame pixels, or None if there was no target
+        with self.lock:
+            if box is None:
+                # Lost the lock, the next frame runs on the full frame
+                self.box = None
+                self.vx = self.vy = 0.0
+                return
+            if self.box is not None and seq > self.boxSeq:
+                frames = seq - self.boxSeq
+                self.vx = ((box[0] + box[2]) - (self.box[0] + self.box[2])) / 2.0 / frames
+                self.vy = ((box[1] + box[3]) - (self.box[1] + self.box[3])) / 2.0 / frames
+            self.box = box
+            self.boxSeq = seq
+
+    def next(self, seq):
+        # Crop (x0, y0, w, h) in full frame pixels for frame seq, or None for the full frame
+        with self.lock:
+            roi = None
+            if self.box is not None and self.sinceFull < self.fullEvery:
+                roi = self.crop(seq)
+            if roi is None:
+                self.sinceFull = 0
+                self.fullFrames += 1
+            else:
+                self.sinceFull += 1
+                self.roiFrames += 1
+            self.current = roi
+            return roi
+
+    def crop(self, seq):
+        xmin, ymin, xmax, ymax = self.box
+        lag = max(1, seq - self.boxSeq)
+        # Where the target should be by now, and room for it to have moved
+        cx = (xmin + xmax) / 2.0 + self.vx * lag
+        cy = (ymin + ymax) / 2.0 + self.vy * lag
+        bw = xmax - xmin
+        bh = ymax - ymin
+        w = bw * (1 + 2 * self.margin) + 2 * abs(self.vx) * lag
+        h = bh * (1 + 2 * self.margin) + 2 * abs(self.vy) * lag
+
+        # Same aspect ratio as the model input so the crop isn't stretched, and not too small
+        if w / h < self.aspect:
+            w = h * self.aspect
+        else:
+            h = w / self.aspect
+        w = max(w, self.minW)
+        h = max(h, self.minH)
+        if w * h > self.maxCover * self.imW * self.imH or w > self.imW or h > self.imH:
+            return None
+
+        # Slide the crop inside the frame rather than cutting it off
+        x0 = min(max(cx - w / 2.0, 0.0), self.imW - w)
+        y0 = min(max(cy - h / 2.0, 0.0), self.imH - h)
+        return (int(x0), int(y0), int(w), int(h))
+
+    def mapBoxes(self, boxes, roi):
+        # Turn normalized [ymin, xmin, ymax, xmax] boxes of the crop into normalized boxes of
+        # the full frame, in place
+        x0, y0, w, h = roi
+        ys = boxes[:, 0::2]
+        xs = boxes[:, 1::2]
+        ys *= h / float(self.imH)
+        ys += y0 / float(self.imH)
+        xs *= w / float(self.imW)
+        xs += x0 / float(self.imW)
+        return boxes
+
+    def stats(self):
+        return {'roiFrames': self.roiFrames, 'fullFrames': self.fullFrames, 'locked': self.box is not None}
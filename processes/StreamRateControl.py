@@ -0,0 +1,73 @@
+# Bandwidth-adaptive stream settings
+#
+# FRC radios cap the robot's bandwidth, and a full 1280x720 JPEG at default quality for every
+# frame can eat most of it. MJPGHandler measures the bytes it actually sends each second (per
+# viewer and in total) and feeds the total here. The controller walks a ladder of
+# (JPEG quality, output scale, frame rate) settings: down as soon as the stream goes over
+# budget (further the more it is over), one step back up after it has stayed well under
+# budget for a few seconds.
+# Lower steps are also cheaper to encode, which gives CPU back to inference.
+
+# (JPEG quality, scale, max fps), best first
+DEFAULT_LADDER = (
+    (80, 1.0, 30),
+    (70, 1.0, 30),
+    (60, 0.75, 30),
+    (50, 0.75, 20),
+    (50, 0.5, 20),
+    (40, 0.5, 15),
+    (30, 0.5, 10),
+    (30, 0.33, 10),
+    (20, 0.33, 5),
+)
+
+
+class StreamRateControl:
+    """Picks stream quality, scale and frame rate to stay under a target bitrate"""
+    def __init__(self, targetKbps, ladder=DEFAULT_LADDER, upRatio=0.6, upAfter=3):
+        self.targetBps = targetKbps * 1000.0 / 8.0
+        self.ladder = ladder
+        # Only step back up once the rate stayed under upRatio of the budget for upAfter updates
+        self.upRatio = upRatio
+        self.upAfter = upAfter
+        self.level = 0
+        self.underCount = 0
+        self.lastRate = 0.0
+
+    @property
+    def quality(self):
+        return self.ladder[self.level][0]
+
+    @property
+    def scale(self):
+        return self.ladder[self.level][1]
+
+    @property
+    def fps(self):
+        return self.ladder[self.level][2]
+
+    def update(self, bytesPerSec):
+        # Called about once a second with the measured send rate, returns True if the settings changed
+        self.lastRate = bytesPerSec
+        if bytesPerSec > self.targetBps:
+            self.underCount = 0
+            if self.level >= len(self.ladder) - 1:
+                return False
+            # One step down, plus one more for every doubling over budget
+            steps = 1
+            ratio = bytesPerSec / self.targetBps
+            while ratio > 2.0:
+                ratio /= 2.0
+                steps += 1
+            self.level = min(self.level + steps, len(self.ladder) - 1)
+            return True
+
+        if bytesPerSec < self.targetBps * self.upRatio:
+            self.underCount += 1
+            if self.underCount >= self.upAfter and self.level > 0:
+                self.underCount = 0
+                self.level -= 1
+                return True
+        else:
+            self.underCount = 0
+        return False
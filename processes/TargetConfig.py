@@ -0,0 +1,44 @@
+# Listener-backed cache of the targeting settings
+#
+# getTargetMode() / getTargetType() used to do a NetworkTables lookup every time they were
+# called, several times per frame and once per detection. This keeps the settings in plain
+# attributes that NT entry listeners update when the dashboard or robot changes them, so the
+# hot loop only reads an attribute and a change takes effect from the next frame.
+
+# largest = 0 centermost = 1 most_confident = 2
+TARGET_MODES = (0, 1, 2)
+
+
+class TargetConfig:
+    """Targeting mode and target type, kept up to date from NT"""
+    def __init__(self, modeTable, typeTable, labels, tgtMode=0, tgtType="robot"):
+        # Class id for every label name, so target type checks are an int compare
+        self.labelIds = {}
+        for classId, name in enumerate(labels):
+            self.labelIds.setdefault(name, classId)
+
+        self.tgtMode = tgtMode
+        self.tgtType = tgtType
+        self.tgtClassId = self.labelIds.get(tgtType, -1)
+
+        # Publish the defaults unless the server already has values, then follow any change.
+        # immediateNotify picks up values that were already on the server before we started
+        modeTable.setDefaultNumber('tgtMode', tgtMode)
+        typeTable.setDefaultString('tgtType', tgtType)
+        modeTable.addEntryListener(self.modeChanged, immediateNotify=True, key='tgtMode', localNotify=True)
+        typeTable.addEntryListener(self.typeChanged, immediateNotify=True, key='tgtType', localNotify=True)
+
+    def modeChanged(self, source, key, value, isNew):
+        try:
+            mode = int(value)
+        except (TypeError, ValueError):
+            return
+        if mode in TARGET_MODES:
+            self.tgtMode = mode
+
+    def typeChanged(self, source, key, value, isNew):
+        if not isinstance(value, str):
+            return
+        # Resolve the name to a class id here, not per detection. Unknown names match nothing
+        self.tgtClassId = self.labelIds.get(value, -1)
+        self.tgtType = value
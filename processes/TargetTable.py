@@ -0,0 +1,80 @@
+# Struct-of-arrays target table
+#
+# Replaces the per-frame list of one dict per target (read back through gettA, gettX, ...
+# and sorted with list.sort(key=...)). The table is one preallocated NumPy array per field
+# with room for a fixed number of targets, refilled in place every frame. The main target
+# is picked with argmax/argmin instead of sorting.
+
+import numpy as np
+
+# Targeting modes, as set in NT 'tgtMode'
+LARGEST = 0
+CENTERMOST = 1
+MOST_CONFIDENT = 2
+
+
+class TargetTable:
+    """Fixed size column arrays holding the targets of one frame, reused every frame"""
+    columns = (
+        ('tgtNum', np.int32), ('tA', np.int32), ('tConf', np.int32),
+        ('tX', np.float32), ('tY', np.float32),
+        ('xCenter', np.float32), ('yCenter', np.float32),
+        ('xmin', np.int32), ('ymin', np.int32), ('xmax', np.int32), ('ymax', np.int32),
+    )
+
+    def __init__(self, maxTargets=16):
+        self.maxTargets = maxTargets
+        self.count = 0
+        for name, dtype in self.columns:
+            setattr(self, name, np.zeros(maxTargets, dtype=dtype))
+
+        # Scratch for the selection keys
+        self.key = np.zeros(maxTargets, dtype=np.float32)
+
+    def fill(self, detections):
+        # Copy the target rows out of a Detections, keeping at most maxTargets of them
+        # (the model returns detections best score first, so the least confident are dropped)
+        d = detections
+        count = min(d.targetCount, self.maxTargets)
+        isTarget = d.isTarget[:d.count]
+        if d.targetCount > self.maxTargets:
+            # Only keep the first maxTargets targets
+            isTarget = self.limit(isTarget)
+        np.compress(isTarget, d.tgtNum[:d.count], out=self.tgtNum[:count])
+        np.compress(isTarget, d.area[:d.count], out=self.tA[:count])
+        np.compress(isTarget, d.conf[:d.count], out=self.tConf[:count])
+        np.compress(isTarget, d.tX[:d.count], out=self.tX[:count])
+        np.compress(isTarget, d.tY[:d.count], out=self.tY[:count])
+        np.compress(isTarget, d.xCenter[:d.count], out=self.xCenter[:count])
+        np.compress(isTarget, d.yCenter[:d.count], out=self.yCenter[:count])
+        np.compress(isTarget, d.xmin[:d.count], out=self.xmin[:count])
+        np.compress(isTarget, d.ymin[:d.count], out=self.ymin[:count])
+        np.compress(isTarget, d.xmax[:d.count], out=self.xmax[:count])
+        np.compress(isTarget, d.ymax[:d.count], out=self.ymax[:count])
+        self.count = count
+        return self
+
+    def limit(self, isTarget):
+        # Mask of the first maxTargets True entries of isTarget
+        limited = isTarget.copy()
+        limited[np.flatnonzero(isTarget)[self.maxTargets:]] = False
+        return limited
+
+    def sortKey(self, mode):
+        # Key where the best target has the highest value
+        n = self.count
+        key = self.key[:n]
+        if mode == CENTERMOST:
+            np.abs(self.tX[:n], out=key)
+            np.negative(key, out=key)
+        elif mode == MOST_CONFIDENT:
+            np.copyto(key, self.tConf[:n], casting='unsafe')
+        else:
+            np.copyto(key, self.tA[:n], casting='unsafe')
+        return key
+
+    def select(self, mode=LARGEST):
+        # Row of the highest priority target for the targeting mode, -1 if there are none
+        if self.count == 0:
+            return -1
+        return int(np.argmax(self.sortKey(mode)))
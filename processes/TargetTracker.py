@@ -0,0 +1,216 @@
+# Constant-velocity tracker that publishes the main target at camera rate
+#
+# Inference runs slower than the camera, so mainTgt tX / tY only changed once per inference,
+# in jumps, and were a few frames old by the time the robot used them. The tracker keeps a
+# small Kalman filter (position and velocity, per axis) for every target, as one set of NumPy
+# arrays for all targets. The publish stage corrects it with every frame's detections, matched
+# to the tracks by IoU. In between, a thread wakes up for every camera frame and publishes where
+# the main target's track predicts it is at that frame's capture time.
+# That only needs the frame's timestamp, no pixels, so it costs microseconds.
+
+import time
+from threading import Thread, Lock
+import numpy as np
+
+
+class TargetTracker:
+    """Kalman filtered target tracks, corrected by detections and predicted for every camera frame"""
+    def __init__(self, postProcessor, ntPublisher, timing=None, maxTracks=16, minIou=0.3, maxMisses=3,
+                 maxAge=0.5, accelNoise=1e5, measNoise=16.0):
+        # postProcessor gives the frame size and degrees per pixel for tX / tY.
+        # A track is dropped after maxMisses detection frames without a match; the main target
+        # is only published while its last detection is at most maxAge seconds old.
+        # accelNoise (px^2/s^3) is how much a target may change speed, measNoise (px^2) how
+        # much a detected box center jitters
+        self.imW = postProcessor.imW
+        self.imH = postProcessor.imH
+        self.xDegPerPx = postProcessor.xDegPerPx
+        self.yDegPerPx = postProcessor.yDegPerPx
+        self.ntPublisher = ntPublisher
+        self.timing = timing
+        self.minIou = minIou
+        self.maxMisses = maxMisses
+        self.maxAge = maxAge
+        self.q = accelNoise
+        self.r = measNoise
+        self.lock = Lock()
+
+        # One row per track, [:, 0] is x and [:, 1] is y. Covariance per axis is [[p00, p01], [p01, p11]]
+        self.active = np.zeros(maxTracks, dtype=np.bool_)
+        self.pos = np.zeros((maxTracks, 2))
+        self.vel = np.zeros((maxTracks, 2))
+        self.p00 = np.zeros((maxTracks, 2))
+        self.p01 = np.zeros((maxTracks, 2))
+        self.p11 = np.zeros((maxTracks, 2))
+        self.size = np.zeros((maxTracks, 2))
+        self.conf = np.zeros(maxTracks)
+        self.tUpdate = np.zeros(maxTracks)
+        self.misses = np.zeros(maxTracks, dtype=np.int32)
+        self.mainTrack = -1
+        self.tCorrect = 0.0
+
+        self.stopped = False
+        self.thread = None
+        self.predictions = 0
+
+    def predictTo(self, rows, t):
+        # Kalman predict of the given tracks forward to time t, in place
+        dt = (t - self.tUpdate[rows])[:, None]
+        np.maximum(dt, 0.0, out=dt)
+        q = self.q
+        p00, p01, p11 = self.p00[rows], self.p01[rows], self.p11[rows]
+        self.pos[rows] += self.vel[rows] * dt
+        self.p00[rows] = p00 + dt * (2 * p01 + dt * p11) + q * dt ** 3 / 3
+        self.p01[rows] = p01 + dt * p11 + q * dt ** 2 / 2
+        self.p11[rows] = p11 + q * dt
+        self.tUpdate[rows] = t
+
+    def correct(self, t, boxes, confs, mainIdx=-1):
+        # Detections of the frame captured at time t: boxes (D x 4, xmin ymin xmax ymax) and
+        # confidences. mainIdx is the row of the main target among them, -1 if there is none
+        t0 = time.perf_counter()
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        centers = (boxes[:, 0:2] + boxes[:, 2:4]) / 2.0
+        sizes = boxes[:, 2:4] - boxes[:, 0:2]
+        with self.lock:
+            if t < self.tCorrect:
+                # Older than detections already used, it would move the tracks back in time
+                return
+            self.tCorrect = t
+            rows = np.flatnonzero(self.active)
+            self.predictTo(rows, t)
+            trackRows, detRows = self.associate(rows, boxes)
+
+            # Kalman update of the matched tracks with the detected box centers
+            if len(trackRows):
+                p00, p01 = self.p00[trackRows], self.p01[trackRows]
+                s = p00 + self.r
+                k0 = p00 / s
+                k1 = p01 / s
+                innovation = centers[detRows] - self.pos[trackRows]
+                self.pos[trackRows] += k0 * innovation
+                self.vel[trackRows] += k1 * innovation
+                self.p11[trackRows] -= k1 * p01
+                self.p00[trackRows] = (1 - k0) * p00
+                self.p01[trackRows] = (1 - k0) * p01
+                self.size[trackRows] = 0.5 * self.size[trackRows] + 0.5 * sizes[detRows]
+                self.conf[trackRows] = confs[detRows]
+                self.misses[trackRows] = 0
+
+            # Tracks nothing matched get a miss, and go after too many
+            unmatched = np.setdiff1d(rows, trackRows, assume_unique=True)
+            self.misses[unmatched] += 1
+            self.active[unmatched[self.misses[unmatched] > self.maxMisses]] = False
+
+            # New tracks for detections nothing matched, as long as there is room
+            trackOf = np.full(len(boxes), -1)
+            trackOf[detRows] = trackRows
+            for det in np.setdiff1d(np.arange(len(boxes)), detRows, assume_unique=True):
+                free = np.flatnonzero(~self.active)
+                if len(free) == 0:
+                    break
+                row = free[0]
+                self.active[row] = True
+                self.pos[row] = centers[det]
+                self.vel[row] = 0.0
+                self.p00[row] = self.r
+                self.p01[row] = 0.0
+                # Unknown speed, up to a few hundred px/s
+                self.p11[row] = 300.0 ** 2
+                self.size[row] = sizes[det]
+                self.conf[row] = confs[det]
+                self.tUpdate[row] = t
+                self.misses[row] = 0
+                trackOf[det] = row
+
+            self.mainTrack = int(trackOf[mainIdx]) if mainIdx >= 0 else -1
+        if self.timing is not None:
+            self.timing.record('trackCorrect', (time.perf_counter() - t0) * 1000.0)
+
+    def associate(self, rows, boxes):
+        # Greedy IoU matching of tracks (at their predicted positions) to detections.
+        # Returns matched (track rows, detection rows)
+        if len(rows) == 0 or len(boxes) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        half = self.size[rows] / 2.0
+        tracks = np.hstack((self.pos[rows] - half, self.pos[rows] + half))
+
+        # IoU of every track with every detection at once, T x D
+        x0 = np.maximum(tracks[:, None, 0], boxes[None, :, 0])
+        y0 = np.maximum(tracks[:, None, 1], boxes[None, :, 1])
+        x1 = np.minimum(tracks[:, None, 2], boxes[None, :, 2])
+        y1 = np.minimum(tracks[:, None, 3], boxes[None, :, 3])
+        inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+        areaT = (tracks[:, 2] - tracks[:, 0]) * (tracks[:, 3] - tracks[:, 1])
+        areaD = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        iou = inter / np.maximum(areaT[:, None] + areaD[None, :] - inter, 1e-9)
+
+        # Best remaining pair first until nothing overlaps enough
+        trackRows = []
+        detRows = []
+        for n in range(min(iou.shape)):
+            best = np.argmax(iou)
+            i, j = np.unravel_index(best, iou.shape)
+            if iou[i, j] < self.minIou:
+                break
+            trackRows.append(rows[i])
+            detRows.append(j)
+            iou[i, :] = -1
+            iou[:, j] = -1
+        return np.array(trackRows, dtype=np.intp), np.array(detRows, dtype=np.intp)
+
+    def predictMain(self, t):
+        # Predicted (xCenter, yCenter, width, height, conf, age) of the main target at time t,
+        # None if there is no main target or its last detection is too old
+        with self.lock:
+            row = self.mainTrack
+            if row < 0 or not self.active[row]:
+                return None
+            # Frames captured before the last detection was made just get its position
+            age = max(t - self.tUpdate[row], 0.0)
+            if age > self.maxAge:
+                return None
+            x, y = self.pos[row] + self.vel[row] * age
+            w, h = self.size[row]
+            return (x, y, w, h, self.conf[row], age)
+
+    def publishMain(self, t):
+        # Put the main target's predicted angles and area for a frame captured at time t
+        t0 = time.perf_counter()
+        main = self.predictMain(t)
+        if main is not None:
+            x, y, w, h, conf, age = main
+            ntPublisher = self.ntPublisher
+            ntPublisher.put('targets/mainTgt/tX', (x - self.imW / 2.0) * self.xDegPerPx)
+            ntPublisher.put('targets/mainTgt/tY', (y - self.imH / 2.0) * self.yDegPerPx)
+            ntPublisher.put('targets/mainTgt/area', w * h / 1000)
+            ntPublisher.put('targets/mainTgt/conf', conf)
+            ntPublisher.put('targets/mainTgt/age', age * 1000.0, tolerance=1.0)
+            ntPublisher.flush()
+            self.predictions += 1
+        if self.timing is not None:
+            self.timing.record('trackPredict', (time.perf_counter() - t0) * 1000.0)
+
+    def start(self, source):
+        # Publish a prediction for every new frame of source (a VideoStream)
+        self.thread = Thread(target=self.run, args=(source,), name='tracker', daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self, source):
+        seq = 0
+        while not self.stopped:
+            newFrame = source.waitNew(seq, timeout=0.5)
+            if newFrame is None:
+                continue
+            seq, stamp = newFrame
+            self.publishMain(stamp)
+
+    def stats(self):
+        return {'tracks': int(self.active.sum()), 'predictions': self.predictions, 'mainTrack': self.mainTrack}
+
+    def stop(self):
+        # run() notices within one waitNew timeout
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join(1.0)
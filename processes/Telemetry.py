@@ -0,0 +1,156 @@
+# Background system telemetry
+#
+# PITemp.readTemp() opens, reads and closes the thermal zone file on every call, which the main
+# loop did once per frame. Telemetry samples the system from its own thread at a fixed low rate
+# and keeps the results in attributes that the pipeline and the NT publisher just read:
+#   tempC       SoC temperature
+#   cpuFreqMHz  current frequency of cpu0
+#   throttled   raw get_throttled bits from the Pi firmware (None if the file doesn't exist)
+#   throttling  True while the firmware is capping frequency / throttling right now
+#   coreLoad    per-core load 0..1 since the previous sample, from /proc/stat
+#   rssMB       resident memory of this process
+#
+# Every file is opened once and re-read with os.pread at offset 0. sysRoot / procRoot can point
+# at a directory of fake files to run it off the Pi.
+
+import os
+import time
+from threading import Thread, Event
+
+# get_throttled bits that mean the CPU is being slowed down right now:
+# 1 = arm frequency capped, 2 = currently throttled, 3 = soft temperature limit active
+THROTTLE_NOW_MASK = 0x2 | 0x4 | 0x8
+
+
+class Telemetry:
+    """Samples temperature, CPU frequency / throttling / load and memory in a background thread"""
+    def __init__(self, interval=1.0, sysRoot='/sys', procRoot='/proc', thermalZone='thermal_zone0'):
+        self.interval = interval
+        self.pageSize = os.sysconf('SC_PAGE_SIZE')
+
+        # Handles stay open for the life of the sampler, None if the file doesn't exist here
+        self.tempFd = self.open(os.path.join(sysRoot, 'class/thermal', thermalZone, 'temp'))
+        self.freqFd = self.open(os.path.join(sysRoot, 'devices/system/cpu/cpu0/cpufreq/scaling_cur_freq'))
+        self.throttleFd = self.open(os.path.join(sysRoot, 'devices/platform/soc/soc:firmware/get_throttled'))
+        self.statFd = self.open(os.path.join(procRoot, 'stat'))
+        self.statmFd = self.open(os.path.join(procRoot, 'self/statm'))
+
+        # Latest values
+        self.tempC = 0.0
+        self.cpuFreqMHz = 0.0
+        self.throttled = None
+        self.throttling = False
+        self.coreLoad = []
+        self.rssMB = 0.0
+        self.sampleTime = 0.0
+
+        # Per-core (idle, total) jiffies from the previous sample
+        self.lastTimes = None
+
+        self.stopped = Event()
+        self.thread = None
+
+    def open(self, path):
+        try:
+            return os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+
+    def readFile(self, fd, size=4096):
+        # Fresh contents of an already open sysfs / procfs file
+        if fd is None:
+            return None
+        try:
+            return os.pread(fd, size, 0)
+        except OSError:
+            return None
+
+    def readNumber(self, fd, base=10):
+        data = self.readFile(fd, 64)
+        if not data:
+            return None
+        try:
+            return int(data.strip(), base)
+        except ValueError:
+            return None
+
+    def start(self):
+        # Take one sample right away so the values are valid as soon as this returns
+        self.sample()
+        self.thread = Thread(target=self.update, args=(), daemon=True)
+        self.thread.start()
+        return self
+
+    def update(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        temp = self.readNumber(self.tempFd)
+        if temp is not None:
+            self.tempC = temp / 1000.0
+
+        freq = self.readNumber(self.freqFd)
+        if freq is not None:
+            self.cpuFreqMHz = freq / 1000.0
+
+        # The firmware reports something like "throttled=0x50005" on older kernels, "0x50005" on newer
+        data = self.readFile(self.throttleFd, 64)
+        if data:
+            try:
+                self.throttled = int(data.strip().split(b'=')[-1], 16)
+                self.throttling = bool(self.throttled & THROTTLE_NOW_MASK)
+            except ValueError:
+                pass
+
+        self.sampleLoad()
+
+        data = self.readFile(self.statmFd, 256)
+        if data:
+            fields = data.split()
+            if len(fields) > 1:
+                self.rssMB = int(fields[1]) * self.pageSize / (1024.0 * 1024.0)
+
+        self.sampleTime = time.monotonic()
+
+    def sampleLoad(self):
+        # Per-core load from the change in busy and idle jiffies since the last sample
+        data = self.readFile(self.statFd, 65536)
+        if not data:
+            return
+        times = []
+        for line in data.split(b'\n'):
+            # "cpuN user nice system idle iowait irq softirq steal ...", skip the "cpu " total line
+            if not line.startswith(b'cpu') or line.startswith(b'cpu '):
+                continue
+            fields = [int(x) for x in line.split()[1:9]]
+            idle = fields[3] + fields[4]
+            times.append((idle, sum(fields)))
+
+        if self.lastTimes is not None and len(self.lastTimes) == len(times):
+            load = []
+            for (idle, total), (lastIdle, lastTotal) in zip(times, self.lastTimes):
+                dTotal = total - lastTotal
+                load.append(1.0 - (idle - lastIdle) / dTotal if dTotal > 0 else 0.0)
+            self.coreLoad = load
+        self.lastTimes = times
+
+    def snapshot(self):
+        # Latest values as a flat dict, e.g. for NT
+        stats = {'tempC': self.tempC, 'cpuFreqMHz': self.cpuFreqMHz,
+                 'throttling': self.throttling, 'rssMB': self.rssMB}
+        if self.throttled is not None:
+            stats['throttled'] = self.throttled
+        for core, load in enumerate(self.coreLoad):
+            stats['core%dLoad' % core] = load
+        return stats
+
+    def stop(self):
+        # Let a sample in progress finish before its files are closed
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for fd in (self.tempFd, self.freqFd, self.throttleFd, self.statFd, self.statmFd):
+            if fd is not None:
+                os.close(fd)
+        self.tempFd = self.freqFd = self.throttleFd = self.statFd = self.statmFd = None
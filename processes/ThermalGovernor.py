@@ -0,0 +1,126 @@
+# Thermal / throttle aware inference governor
+#
+# In a closed robot bay the Pi heats up until the firmware throttles the CPU, and then the
+# frame rate collapses in the middle of a match. The governor watches the temperature and
+# throttle state from a Telemetry (or a SimulatedTelemetry) and walks a policy table of levels,
+# each capping the inference frame rate and the number of interpreters running at once.
+# It steps down as the temperature passes each level's threshold, before the firmware's own
+# limit is reached, right away if the firmware reports throttling anyway, and steps back up
+# one level at a time once it has stayed a margin under the current level's threshold for a while.
+#
+# The governor only decides, the caller applies maxFps / interpreters and publishes the state.
+
+import time
+
+# (step down at tempC, max inference fps (0 = no cap), max interpreters (0 = all)), coolest first.
+# The Pi 4 firmware starts soft throttling at 80C
+DEFAULT_POLICY = (
+    (0.0, 0, 0),
+    (70.0, 20, 0),
+    (74.0, 15, 2),
+    (77.0, 10, 1),
+    (79.0, 5, 1),
+)
+
+
+class ThermalGovernor:
+    """Picks an inference rate and interpreter count from temperature and throttle state"""
+    def __init__(self, telemetry, policy=DEFAULT_POLICY, hysteresis=3.0, upAfter=5.0):
+        # telemetry needs tempC and throttling attributes.
+        # Step up only after the temperature stayed hysteresis degrees under the current
+        # level's threshold for upAfter seconds
+        self.telemetry = telemetry
+        self.policy = policy
+        self.hysteresis = hysteresis
+        self.upAfter = upAfter
+        self.level = 0
+        self.coolSince = None
+        self.reason = 'start'
+        self.changes = 0
+
+    @property
+    def maxFps(self):
+        return self.policy[self.level][1]
+
+    @property
+    def interpreters(self):
+        return self.policy[self.level][2]
+
+    def update(self, now=None):
+        # Called about once a second, returns True if the level changed
+        now = time.monotonic() if now is None else now
+        tempC = self.telemetry.tempC
+
+        # Highest level whose threshold we are at or above
+        target = 0
+        for level, (threshold, maxFps, interpreters) in enumerate(self.policy):
+            if tempC >= threshold:
+                target = level
+
+        if self.telemetry.throttling and self.level < len(self.policy) - 1:
+            # Already throttled, we were too late, go down a step every update until it stops
+            target = max(target, self.level + 1)
+            return self.setLevel(target, 'throttled %.1fC' % tempC)
+
+        if target > self.level:
+            return self.setLevel(target, 'hot %.1fC' % tempC)
+
+        if self.level > 0 and tempC < self.policy[self.level][0] - self.hysteresis:
+            if self.coolSince is None:
+                self.coolSince = now
+            elif now - self.coolSince >= self.upAfter:
+                return self.setLevel(self.level - 1, 'cool %.1fC' % tempC)
+        else:
+            self.coolSince = None
+        return False
+
+    def setLevel(self, level, reason):
+        self.coolSince = None
+        if level == self.level:
+            return False
+        self.level = level
+        self.reason = reason
+        self.changes += 1
+        print("governor: level %d (fps cap %s, interpreters %s), %s" % (
+            level, self.maxFps or 'none', self.interpreters or 'all', reason))
+        return True
+
+    def state(self):
+        return {'level': self.level, 'maxFps': self.maxFps, 'interpreters': self.interpreters,
+                'reason': self.reason, 'changes': self.changes}
+
+
+class SimulatedTelemetry:
+    """Stand-in for Telemetry that plays back a temperature profile, to try a policy off the robot"""
+    def __init__(self, profile, throttleC=80.0):
+        # profile is a list of (seconds since start, tempC) points, linearly interpolated and
+        # held at the last value. Reports throttling at or above throttleC, like the firmware
+        self.profile = sorted(profile)
+        self.throttleC = throttleC
+        self.startTime = time.monotonic()
+
+    @classmethod
+    def parse(cls, text, throttleC=80.0):
+        # "tempC@seconds,..." e.g. "50@0,82@60,55@120"
+        profile = []
+        for point in text.split(','):
+            tempC, seconds = point.split('@')
+            profile.append((float(seconds), float(tempC)))
+        return cls(profile, throttleC)
+
+    def tempAt(self, seconds):
+        points = self.profile
+        if seconds <= points[0][0]:
+            return points[0][1]
+        for (t0, c0), (t1, c1) in zip(points, points[1:]):
+            if seconds <= t1:
+                return c0 + (c1 - c0) * (seconds - t0) / (t1 - t0) if t1 > t0 else c1
+        return points[-1][1]
+
+    @property
+    def tempC(self):
+        return self.tempAt(time.monotonic() - self.startTime)
+
+    @property
+    def throttling(self):
+        return self.tempC >= self.throttleC
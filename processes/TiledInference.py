@@ -0,0 +1,215 @@
+# Tiled, multi-scale inference for high resolution frames
+#
+# Squeezing a 1280x720 frame into a 300x300 model input leaves a game piece far downfield a
+# pixel or two. A tiled pass runs the model on the whole frame and on overlapping tiles of the
+# frame at native resolution (model input size x tileScale). Tiles run in parallel on whichever
+# pool interpreters are free at that moment, at least on the one the frame already holds, but
+# `reserve` of them are always left to the full frame passes of the frames behind it. A
+# borrowed interpreter goes back to the pool as soon as no tiles are left for it.
+#
+# Every tile's boxes are mapped back onto the full frame. The model already ran NMS within each
+# tile, so only pairs from different tiles (or the full frame) can be duplicates: the same
+# object, often cut off at a tile edge in one of them. Those are suppressed greedily over the
+# overlap matrix of all boxes: best box first, every kept box drops the lower scoring boxes of
+# its class from other tiles whose intersection with it covers more than mergeOverlap of the
+# smaller box. A box that was dropped never drops others. The merged result is padded back to
+# the model's fixed number of detections, so PostProcessor sees the same shapes either way.
+#
+# A tiled pass costs several invokes. nextPass() only asks for one as often as the frame-time
+# budget allows: with full passes taking fullMs and tiled passes tiledMs (both averaged as they
+# run), one frame in every `period` is tiled so the average stays under budgetMs.
+
+import math
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from processes.Preprocessor import Preprocessor
+
+
+class TiledInference:
+    """Runs a frame as full frame + overlapping tiles and merges the results, on a time budget"""
+    def __init__(self, interpreterPool, imW, imH, tileScale=1.0, overlap=0.2, budgetMs=100.0, minScore=0.3,
+                 mergeOverlap=0.6, inputMean=127.5, inputStd=127.5, alpha=0.2, reserve=1):
+        self.interpreterPool = interpreterPool
+        self.reserve = reserve
+        self.imW = imW
+        self.imH = imH
+        self.budgetMs = budgetMs
+        self.minScore = minScore
+        self.mergeOverlap = mergeOverlap
+        self.inputMean = inputMean
+        self.inputStd = inputStd
+        self.alpha = alpha
+
+        inputH, inputW = interpreterPool.input_details[0]['shape'][1:3]
+        self.tiles = [(0, 0, imW, imH)] + self.layout(int(inputW * tileScale), int(inputH * tileScale), overlap)
+        # Scores output is [1 x detections]
+        self.numDetections = int(interpreterPool.output_details[2]['shape'][1])
+
+        # Preprocessor buffers aren't shared between threads, one per thread running tiles
+        self.local = threading.local()
+        self.executor = None
+
+        # Scheduling
+        self.fullMs = None
+        self.tiledMs = None
+        self.sinceTiled = 0
+        self.fullPasses = 0
+        self.tiledPasses = 0
+
+    def layout(self, tileW, tileH, overlap):
+        # Overlapping tiles (x0, y0, w, h) covering the frame, spread evenly edge to edge
+        tileW = min(tileW, self.imW)
+        tileH = min(tileH, self.imH)
+        cols = int(math.ceil((self.imW - tileW) / (tileW * (1.0 - overlap)))) + 1
+        rows = int(math.ceil((self.imH - tileH) / (tileH * (1.0 - overlap)))) + 1
+        if cols == 1 and rows == 1:
+            # One tile is just the full frame again
+            return []
+        xs = np.linspace(0, self.imW - tileW, cols).astype(int)
+        ys = np.linspace(0, self.imH - tileH, rows).astype(int)
+        return [(int(x), int(y), tileW, tileH) for y in ys for x in xs]
+
+    def nextPass(self, seq):
+        # True if frame seq should get a tiled pass
+        # Not even a full pass fits, or nothing timed yet
+        if not self.budgetMs or self.fullMs is None or self.budgetMs <= self.fullMs:
+            return False
+        self.sinceTiled += 1
+        if self.tiledMs is None:
+            # Tiled passes never timed yet, try one
+            return self.claim()
+        period = max(1, int(math.ceil((self.tiledMs - self.fullMs) / (self.budgetMs - self.fullMs))))
+        if self.sinceTiled >= period:
+            return self.claim()
+        return False
+
+    def claim(self):
+        self.sinceTiled = 0
+        return True
+
+    def recordFull(self, ms):
+        # Time of a full frame invoke, from the infer stage
+        self.fullPasses += 1
+        self.fullMs = ms if self.fullMs is None else self.fullMs + self.alpha * (ms - self.fullMs)
+
+    def recordTiled(self, ms):
+        self.tiledPasses += 1
+        self.tiledMs = ms if self.tiledMs is None else self.tiledMs + self.alpha * (ms - self.tiledMs)
+
+    def run(self, frame, interpreter):
+        # Tiled pass over frame, interpreter is the one the frame already holds (not released
+        # here). Returns boxes / classes / scores like the model's own outputs
+        t0 = time.perf_counter()
+        tiles = self.tiles
+        results = [None] * len(tiles)
+        nextTile = itertools.count()
+
+        def work(worker):
+            # Take tiles until none are left
+            while True:
+                i = next(nextTile)
+                if i >= len(tiles):
+                    return
+                results[i] = self.runTile(worker, frame, tiles[i])
+
+        def borrowed(worker):
+            try:
+                work(worker)
+            finally:
+                self.interpreterPool.release(worker)
+
+        # Borrow any other interpreter that is free right now, never wait for one, and leave
+        # reserve of them to the other frames
+        extra = []
+        maxExtra = min(len(tiles) - 1, self.interpreterPool.active - 1 - self.reserve)
+        while len(extra) < maxExtra:
+            other = self.interpreterPool.acquire(timeout=0)
+            if other is None:
+                break
+            extra.append(other)
+        futures = []
+        try:
+            if extra and self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.interpreterPool.size, thread_name_prefix='tile')
+            for other in extra:
+                futures.append(self.executor.submit(borrowed, other))
+            work(interpreter)
+            for future in futures:
+                future.result()
+        finally:
+            # Only the ones that never got a worker, the others give themselves back
+            for other in extra[len(futures):]:
+                self.interpreterPool.release(other)
+
+        merged = self.merge(results)
+        self.recordTiled((time.perf_counter() - t0) * 1000.0)
+        return merged
+
+    def runTile(self, interpreter, frame, tile):
+        preprocessor = getattr(self.local, 'preprocessor', None)
+        if preprocessor is None:
+            preprocessor = Preprocessor(self.interpreterPool.input_details[0], self.inputMean, self.inputStd)
+            self.local.preprocessor = preprocessor
+        x0, y0, w, h = tile
+        preprocessor.into(frame[y0:y0+h, x0:x0+w], interpreter)
+        interpreter.invoke()
+        outputs = self.interpreterPool.getOutputs(interpreter)
+        boxes, classes, scores = outputs[0][0], outputs[1][0], outputs[2][0]
+
+        # Normalized [ymin, xmin, ymax, xmax] of the tile -> normalized of the full frame
+        boxes[:, 0::2] *= h / float(self.imH)
+        boxes[:, 0::2] += y0 / float(self.imH)
+        boxes[:, 1::2] *= w / float(self.imW)
+        boxes[:, 1::2] += x0 / float(self.imW)
+        return boxes, classes, scores
+
+    def merge(self, results):
+        # Cross-tile NMS over every tile's detections, best numDetections kept
+        boxes = np.concatenate([r[0] for r in results])
+        classes = np.concatenate([r[1] for r in results])
+        scores = np.concatenate([r[2] for r in results])
+        tileIds = np.repeat(np.arange(len(results)), [len(r[2]) for r in results])
+
+        # Best first, weak ones never make it into the matrix
+        order = np.argsort(-scores)
+        order = order[scores[order] >= self.minScore]
+        boxes, classes, scores, tileIds = boxes[order], classes[order], scores[order], tileIds[order]
+
+        # Intersection over the smaller box of every pair
+        ymin = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+        xmin = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+        ymax = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+        xmax = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+        inter = np.clip(ymax - ymin, 0, None) * np.clip(xmax - xmin, 0, None)
+        area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        overlap = inter / np.maximum(np.minimum(area[:, None], area[None, :]), 1e-9)
+
+        # A box goes if a better box of the same class from another tile that was kept covers it
+        duplicate = (overlap > self.mergeOverlap) & (classes[:, None] == classes[None, :]) \
+            & (tileIds[:, None] != tileIds[None, :])
+        keep = np.ones(len(scores), dtype=bool)
+        for i in range(len(scores)):
+            if keep[i]:
+                keep[i+1:] &= ~duplicate[i, i+1:]
+
+        # Same shapes as one invoke's outputs, empty rows have score 0
+        n = self.numDetections
+        kept = np.flatnonzero(keep)[:n]
+        outBoxes = np.zeros((n, 4), dtype=np.float32)
+        outClasses = np.zeros(n, dtype=np.float32)
+        outScores = np.zeros(n, dtype=np.float32)
+        outBoxes[:len(kept)] = boxes[kept]
+        outClasses[:len(kept)] = classes[kept]
+        outScores[:len(kept)] = scores[kept]
+        return outBoxes, outClasses, outScores
+
+    def stats(self):
+        return {'tiles': len(self.tiles) - 1, 'fullPasses': self.fullPasses, 'tiledPasses': self.tiledPasses,
+                'fullMs': self.fullMs or 0.0, 'tiledMs': self.tiledMs or 0.0}
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -1,49 +1,147 @@
 # THIS IS YOUR INPUT VIDEO STREAM WITHOUT ANY POST PROCESSING
 
-# Defining VideoStream class to handle streaming of video from webcam in separate processing thread 
+# Defining VideoStream class to handle streaming of video from webcam in separate processing thread
 # Source - Adrian Rosebrock, PyImageSearch: https://www.pyimagesearch.com/2015/12/28/increasing-raspberry-pi-fps-with-python-and-opencv/
-from threading import Thread
+#
+# Frames are captured into a small ring of preallocated buffers (triple buffer by default).
+# Every captured frame gets a sequence number and a capture timestamp, so the main loop can
+# tell whether it already processed the latest frame instead of running inference twice on it.
+# Frames handed to a multi-stage pipeline can be held with readNew(hold=True) and given back
+# with release(seq), so the capture thread never overwrites a frame that is still in flight.
+from threading import Thread, Condition
+import time
 import cv2
 
 class VideoStream:
     """Camera object that controls video streaming from the Picamera"""
-    def __init__(self,resolution=(640,480),framerate=30):
-        # Initialize the PiCamera and the camera image stream
-        self.stream = cv2.VideoCapture(0)
+    def __init__(self,resolution=(640,480),framerate=30,buffers=3,src=0):
+        # Initialize the PiCamera and the camera image stream.
+        # src is anything cv2.VideoCapture opens: a device index, a /dev/video path or a stream URL
+        self.stream = cv2.VideoCapture(src)
         ret = self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
         ret = self.stream.set(3,resolution[0])
         ret = self.stream.set(4,resolution[1])
-            
+
+        # Need at least 3 slots so the capture thread always has a free slot to write into
+        # while one slot holds the latest frame and another is checked out by the reader
+        self.buffers = [None] * max(3, buffers)
+        self.latestSlot = 0
+        self.readSlot = -1
+        self.holds = [0] * len(self.buffers)
+        self.slotSeq = [0] * len(self.buffers)
+        self.seq = 0
+        self.timestamp = 0.0
+        self.cond = Condition()
+
         # Read first frame from the stream
-        (self.grabbed, self.frame) = self.stream.read()
+        (self.grabbed, self.buffers[0]) = self.stream.read()
+        if self.grabbed:
+            self.seq = 1
+            self.slotSeq[0] = 1
+            self.timestamp = time.monotonic()
 
 	# Variable to control when the camera is stopped
         self.stopped = False
 
+    @property
+    def frame(self):
+        # Most recently captured frame (kept for code that still reads .frame directly)
+        return self.buffers[self.latestSlot]
+
     def start(self):
 	# Start the thread that reads frames from the video stream
         Thread(target=self.update,args=()).start()
         return self
 
+    def _freeSlot(self):
+        # Pick a slot that is not the latest frame, not the one the reader is using and not held.
+        # Returns None if every slot is busy
+        for slot in range(len(self.buffers)):
+            if slot != self.latestSlot and slot != self.readSlot and self.holds[slot] == 0:
+                return slot
+        return None
+
     def update(self):
         # Keep looping indefinitely until the thread is stopped
         while True:
             # If the camera is stopped, stop the thread
             if self.stopped:
-                # Close camera resources
+                # Close camera resources and wake up anyone waiting on a frame
                 self.stream.release()
+                with self.cond:
+                    self.cond.notify_all()
                 return
 
-            # Otherwise, grab the next frame from the stream
-            (self.grabbed, self.frame) = self.stream.read()
+            # Otherwise, grab the next frame from the stream straight into a free buffer
+            with self.cond:
+                slot = self._freeSlot()
+                # All buffers are held downstream, wait for one to be released
+                while slot is None and not self.stopped:
+                    self.cond.wait(0.1)
+                    slot = self._freeSlot()
+            if slot is None:
+                continue
+            (grabbed, img) = self.stream.read(self.buffers[slot])
+            stamp = time.monotonic()
+            if not grabbed:
+                self.grabbed = False
+                continue
+
+            # Publish the slot as the newest frame
+            with self.cond:
+                # OpenCV reallocates if the frame size changed, keep whatever it handed back
+                self.buffers[slot] = img
+                self.latestSlot = slot
+                self.seq += 1
+                self.slotSeq[slot] = self.seq
+                self.timestamp = stamp
+                self.grabbed = True
+                self.cond.notify_all()
 
     def read(self):
     # Return the most recent frame
         return self.frame
 
+    def readNew(self, lastSeq=0, timeout=None, hold=False):
+        # Return (seq, timestamp, frame) for the newest frame if it is newer than lastSeq.
+        # timeout=None blocks until a new frame arrives, timeout=0 never blocks.
+        # Returns None when there is no new frame (or the stream was stopped).
+        # The frame is NOT copied: it stays valid until the next readNew() call,
+        # or with hold=True until release(seq) is called for it.
+        with self.cond:
+            if self.seq <= lastSeq and timeout != 0:
+                self.cond.wait_for(lambda: self.seq > lastSeq or self.stopped, timeout)
+            if self.seq <= lastSeq or self.buffers[self.latestSlot] is None:
+                return None
+            slot = self.latestSlot
+            if hold:
+                self.holds[slot] += 1
+            else:
+                self.readSlot = slot
+            return (self.seq, self.timestamp, self.buffers[slot])
+
+    def waitNew(self, lastSeq=0, timeout=None):
+        # Return (seq, timestamp) of the newest frame once it is newer than lastSeq, without
+        # taking the frame itself. None on timeout or when the stream was stopped
+        with self.cond:
+            if self.seq <= lastSeq:
+                self.cond.wait_for(lambda: self.seq > lastSeq or self.stopped, timeout)
+            if self.seq <= lastSeq:
+                return None
+            return (self.seq, self.timestamp)
+
+    def release(self, seq):
+        # Give back a frame taken with readNew(hold=True)
+        with self.cond:
+            for slot in range(len(self.buffers)):
+                if self.slotSeq[slot] == seq and self.holds[slot] > 0:
+                    self.holds[slot] -= 1
+                    self.cond.notify_all()
+                    return
+
     def show(frame):
         cv2.imshow("VideoStream",frame)
 
     def stop(self):
 	# Indicate that the camera and thread should be stopped
-        self.stopped = True
\ No newline at end of file
+        self.stopped = True